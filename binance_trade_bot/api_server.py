@@ -1,18 +1,30 @@
+import hashlib
 import re
+import threading
 from datetime import datetime, timedelta
+from functools import wraps
 from itertools import groupby
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
-from flask import Flask, jsonify, request
+from cachetools import LRUCache
+from flask import Flask, Response, abort, json, jsonify, make_response, request, stream_with_context
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.engine import RowProxy
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import Select
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .config import Config
 from .database import Database
 from .logger import Logger
-from .models import Coin, CoinValue, CurrentCoin, Pair, ScoutHistory, Trade
+from .models import Coin, CoinValue, CurrentCoin, Pair, ScoutHistory, TotalValue, Trade
 
 app = Flask(__name__)
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -24,89 +36,390 @@ logger = Logger("api_server")
 config = Config()
 db = Database(logger, config)
 
+# Responses of the cached endpoints by URL, along with the version of the tables they were made from
+response_cache = LRUCache(maxsize=256)
+response_cache_lock = threading.Lock()
 
-def filter_period(query, model):  # pylint: disable=inconsistent-return-statements
-    period = request.args.get("period", "all")
-
-    if period == "all":
-        return query
 
-    num = float(re.search(r"(\d*)[shdwm]", "1d").group(1))
-
-    if "s" in period:
-        return query.filter(model.datetime >= datetime.now() - timedelta(seconds=num))
-    if "h" in period:
-        return query.filter(model.datetime >= datetime.now() - timedelta(hours=num))
-    if "d" in period:
-        return query.filter(model.datetime >= datetime.now() - timedelta(days=num))
-    if "w" in period:
-        return query.filter(model.datetime >= datetime.now() - timedelta(weeks=num))
-    if "m" in period:
-        return query.filter(model.datetime >= datetime.now() - timedelta(days=28 * num))
+def get_table_version(model) -> Tuple:
+    """
+    Tell whether a table changed. It is only ever appended to and pruned, which moves its highest id or its row count,
+    so this follows the bot's writes without having to hear from it
+    """
+    session: Session
+    with db.db_session() as session:
+        return tuple(session.query(func.max(model.id), func.count(model.id)).one())
+
+
+def cached_response(model):
+    """
+    Serve a view from memory until the table its response follows changes, and answer 304 Not Modified to clients
+    that already have the current response. A response to a relative ?period= is also only kept for the minute it was
+    made in, as rows leave the period with time even when the table doesn't change
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.full_path
+            version = get_table_version(model)
+            if request.args.get("period", "all") != "all":
+                version += (datetime.utcnow().replace(second=0, microsecond=0),)
+            etag = hashlib.sha1(repr((key, version)).encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            with response_cache_lock:
+                cached = response_cache.get(key)
+            if cached is None or cached[0] != version:
+                response = make_response(view(*args, **kwargs))
+                if response.is_streamed:
+                    # Only kept whole in memory by the client
+                    response.set_etag(etag)
+                    return response
+                cached = (version, response.get_data(), response.mimetype)
+                with response_cache_lock:
+                    response_cache[key] = cached
+            response = app.response_class(cached[1], mimetype=cached[2])
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def dumps(data, pretty=False) -> bytes:
+    """
+    Encode JSON the way jsonify does, with sorted keys. Uses orjson when it is installed, which is several times faster
+    than the json module
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+    return json.dumps(data, indent=2 if pretty else None, separators=(", ", ": ") if pretty else (",", ":")).encode()
+
+
+def json_response(data):
+    """
+    Same response as jsonify
+    """
+    pretty = app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug
+    return app.response_class(dumps(data, pretty) + b"\n", mimetype=app.config["JSONIFY_MIMETYPE"])
+
+
+def fetch_all(query: Select) -> List[RowProxy]:
+    session: Session
+    with db.db_session() as session:
+        return session.execute(query).fetchall()
+
+
+def coin_info(symbol: str, enabled: bool) -> Dict:
+    """
+    Coin.info() of a coin selected as columns
+    """
+    return {"symbol": symbol, "enabled": enabled}
+
+
+# Largest page of history a request can ask for
+MAX_PAGE_SIZE = 10000
+# Rows fetched from SQLite at a time when streaming
+STREAM_BATCH_SIZE = 1000
+
+
+def history_response(query: Select, model, info: Callable[[RowProxy], Dict], default: Callable[[Select], Response]):
+    """
+    Respond with the rows of a history, in order of time:
+    - by default as built by default from the whole query
+    - with ?limit=n, a page of n rows as {"data": [...], "next": cursor}. Pass the cursor as ?after= to get the next
+      page, it is null after the last one. Pages are found through the (datetime, id) index, however deep they are
+    - with ?format=ndjson, every row as one JSON document per line, streamed from the database so memory use doesn't
+      grow with the number of rows
+
+    :param query: Select of the rows, which must have the model's datetime and id
+    :param info: Make the JSON of a row
+    :param default: Make the response from the query, when neither paging nor streaming
+    """
+    query = ordered_by_time(query, model)
+    if request.args.get("format") == "ndjson":
+
+        def generate():
+            session: Session
+            with db.db_session() as session:
+                result = session.execute(query)
+                while True:
+                    rows = result.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        return
+                    # One chunk per batch, as writing out each row on its own costs more than encoding it
+                    yield b"".join(dumps(info(row)) + b"\n" for row in rows)
+
+        return app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    if "limit" not in request.args:
+        return default(query)
+
+    try:
+        limit = int(request.args["limit"])
+    except ValueError:
+        abort(400, "limit must be a number")
+    if limit < 1:
+        # A negative LIMIT is no limit at all to SQLite
+        abort(400, "limit must be at least 1")
+    limit = min(limit, MAX_PAGE_SIZE)
+    after = request.args.get("after")
+    if after:
+        try:
+            after_datetime, after_id = after.rsplit(",", 1)
+            query = query.where(
+                tuple_(model.datetime, model.id) > tuple_(datetime.fromisoformat(after_datetime), int(after_id))
+            )
+        except ValueError:
+            abort(400, "after must be a cursor returned by a previous page")
+
+    rows = fetch_all(query.limit(limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].datetime.isoformat()},{rows[-1].id}"
+    return json_response({"data": [info(row) for row in rows], "next": next_cursor})
+
+
+def ordered_by_time(query: Select, model) -> Select:
+    return query.order_by(None).order_by(model.datetime.asc(), model.id.asc())
+
+
+# Length of each unit of a relative period, e.g. "12h" or "2w". A month counts as 4 weeks
+PERIOD_UNITS = {
+    "s": timedelta(seconds=1),
+    "h": timedelta(hours=1),
+    "d": timedelta(days=1),
+    "w": timedelta(weeks=1),
+    "m": timedelta(days=28),
+}
+# Tables whose times are saved in UTC rather than local time
+UTC_MODELS = (ScoutHistory, Trade, CurrentCoin)
+
+
+def get_time_range(model) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Get the range of times asked for, from a relative ?period= that ends now, or from an absolute ?start= and ?end=
+    in ISO 8601 (either can be left out). None for an open end
+
+    :raises ValueError: for a range that can't be parsed
+    """
+    period = request.args.get("period", "all")
+    if period != "all":
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)([shdwm])", period)
+        if match is None:
+            raise ValueError(f"Unknown period {period}")
+        now = datetime.utcnow() if issubclass(model, UTC_MODELS) else datetime.now()
+        return now - float(match.group(1)) * PERIOD_UNITS[match.group(2)], None
+
+    start, end = request.args.get("start"), request.args.get("end")
+    return (
+        datetime.fromisoformat(start) if start else None,
+        datetime.fromisoformat(end) if end else None,
+    )
+
+
+def filter_period(query: Select, model) -> Select:
+    """
+    Keep the rows of the range of times asked for. Every history table is indexed on its time, so this reads only the
+    rows in range
+    """
+    try:
+        start, end = get_time_range(model)
+    except ValueError as e:
+        abort(400, str(e))
+    if start is not None:
+        query = query.where(model.datetime >= start)
+    if end is not None:
+        query = query.where(model.datetime < end)
+    return query
 
 
 @app.route("/api/value_history/<coin>")
 @app.route("/api/value_history")
+# Coin values are saved and pruned along with their totals, a much smaller table to count
+@cached_response(TotalValue)
 def value_history(coin: str = None):
-    session: Session
-    with db.db_session() as session:
-        query = session.query(CoinValue).order_by(CoinValue.coin_id.asc(), CoinValue.datetime.asc())
-
-        query = filter_period(query, CoinValue)
-
+    query = select(
+        [
+            CoinValue.coin_id,
+            CoinValue.balance,
+            CoinValue.usd_value.label("usd_value"),
+            CoinValue.btc_value.label("btc_value"),
+            CoinValue.datetime,
+            CoinValue.id,
+        ]
+    )
+    if coin:
+        query = query.where(CoinValue.coin_id == coin)
+    query = filter_period(query, CoinValue)
+
+    def coin_value_info(cv: RowProxy):
+        _, balance, usd_value, btc_value, cv_datetime, _ = cv
+        return {"balance": balance, "usd_value": usd_value, "btc_value": btc_value, "datetime": cv_datetime.isoformat()}
+
+    def info(cv: RowProxy):
+        # Pages and streams of every coin are in order of time, so each row says which coin it is about
+        return coin_value_info(cv) if coin else {"coin": cv[0], **coin_value_info(cv)}
+
+    def default(query: Select):
+        coin_values = fetch_all(query.order_by(None).order_by(CoinValue.coin_id.asc(), CoinValue.datetime.asc()))
         if coin:
-            values: List[CoinValue] = query.filter(CoinValue.coin_id == coin).all()
-            return jsonify([entry.info() for entry in values])
+            return json_response([coin_value_info(cv) for cv in coin_values])
+        return json_response(
+            {
+                symbol: [coin_value_info(cv) for cv in history]
+                for symbol, history in groupby(coin_values, key=lambda cv: cv[0])
+            }
+        )
 
-        coin_values = groupby(query.all(), key=lambda cv: cv.coin)
-        return jsonify({coin.symbol: [entry.info() for entry in history] for coin, history in coin_values})
+    return history_response(query, CoinValue, info, default)
 
 
 @app.route("/api/total_value_history")
+@cached_response(TotalValue)
 def total_value_history():
-    session: Session
-    with db.db_session() as session:
-        query = session.query(
-            CoinValue.datetime,
-            func.sum(CoinValue.btc_value),
-            func.sum(CoinValue.usd_value),
-        ).group_by(CoinValue.datetime)
-
-        query = filter_period(query, CoinValue)
-
-        total_values: List[Tuple[datetime, float, float]] = query.all()
-        return jsonify([{"datetime": tv[0], "btc": tv[1], "usd": tv[2]} for tv in total_values])
+    query = select([TotalValue.datetime, TotalValue.btc_value, TotalValue.usd_value]).order_by(
+        TotalValue.datetime.asc()
+    )
+    query = filter_period(query, TotalValue)
+    # jsonify sends datetimes as HTTP dates
+    return json_response(
+        [
+            {"datetime": http_date(tv_datetime.utctimetuple()), "btc": btc_value, "usd": usd_value}
+            for tv_datetime, btc_value, usd_value in fetch_all(query)
+        ]
+    )
+
+
+def trade_info(trade: RowProxy) -> Dict:
+    """
+    Trade.info() of a trade selected by trade_history. Rows are unpacked, which is much faster than getting each
+    column by name
+    """
+    (
+        trade_id,
+        selling,
+        state,
+        alt_starting_balance,
+        alt_trade_amount,
+        crypto_starting_balance,
+        crypto_trade_amount,
+        trade_datetime,
+        alt_coin_symbol,
+        alt_coin_enabled,
+        crypto_coin_symbol,
+        crypto_coin_enabled,
+    ) = trade
+    return {
+        "id": trade_id,
+        "alt_coin": coin_info(alt_coin_symbol, alt_coin_enabled),
+        "crypto_coin": coin_info(crypto_coin_symbol, crypto_coin_enabled),
+        "selling": selling,
+        "state": state.value,
+        "alt_starting_balance": alt_starting_balance,
+        "alt_trade_amount": alt_trade_amount,
+        "crypto_starting_balance": crypto_starting_balance,
+        "crypto_trade_amount": crypto_trade_amount,
+        "datetime": trade_datetime.isoformat(),
+    }
 
 
 @app.route("/api/trade_history")
 def trade_history():
-    session: Session
-    with db.db_session() as session:
-        query = session.query(Trade).order_by(Trade.datetime.asc())
-
-        query = filter_period(query, Trade)
-
-        trades: List[Trade] = query.all()
-        return jsonify([trade.info() for trade in trades])
+    alt_coin, crypto_coin = aliased(Coin), aliased(Coin)
+    query = select(
+        [
+            Trade.id,
+            Trade.selling,
+            Trade.state,
+            Trade.alt_starting_balance,
+            Trade.alt_trade_amount,
+            Trade.crypto_starting_balance,
+            Trade.crypto_trade_amount,
+            Trade.datetime,
+            alt_coin.symbol.label("alt_coin_symbol"),
+            alt_coin.enabled.label("alt_coin_enabled"),
+            crypto_coin.symbol.label("crypto_coin_symbol"),
+            crypto_coin.enabled.label("crypto_coin_enabled"),
+        ]
+    ).select_from(
+        Trade.__table__.join(alt_coin, Trade.alt_coin_id == alt_coin.symbol).join(
+            crypto_coin, Trade.crypto_coin_id == crypto_coin.symbol
+        )
+    )
+    return history_response(
+        filter_period(query, Trade),
+        Trade,
+        trade_info,
+        lambda query: json_response([trade_info(trade) for trade in fetch_all(query)]),
+    )
+
+
+def scout_info(scout: RowProxy) -> Dict:
+    """
+    ScoutHistory.info() of a scout selected by scouting_history
+    """
+    (
+        _,
+        target_ratio,
+        current_coin_price,
+        other_coin_price,
+        scout_datetime,
+        from_coin_symbol,
+        from_coin_enabled,
+        to_coin_symbol,
+        to_coin_enabled,
+    ) = scout
+    return {
+        "from_coin": coin_info(from_coin_symbol, from_coin_enabled),
+        "to_coin": coin_info(to_coin_symbol, to_coin_enabled),
+        "current_ratio": current_coin_price / other_coin_price,
+        "target_ratio": target_ratio,
+        "current_coin_price": current_coin_price,
+        "other_coin_price": other_coin_price,
+        "datetime": scout_datetime.isoformat(),
+    }
 
 
 @app.route("/api/scouting_history")
 def scouting_history():
     _current_coin = db.get_current_coin()
     coin = _current_coin.symbol if _current_coin is not None else None
-    session: Session
-    with db.db_session() as session:
-        query = (
-            session.query(ScoutHistory)
-            .join(ScoutHistory.pair)
-            .filter(Pair.from_coin_id == coin)
-            .order_by(ScoutHistory.datetime.asc())
-        )
 
-        query = filter_period(query, ScoutHistory)
-
-        scouts: List[ScoutHistory] = query.all()
-        return jsonify([scout.info() for scout in scouts])
+    from_coin, to_coin = aliased(Coin), aliased(Coin)
+    query = (
+        select(
+            [
+                ScoutHistory.id,
+                ScoutHistory.target_ratio,
+                ScoutHistory.current_coin_price,
+                ScoutHistory.other_coin_price,
+                ScoutHistory.datetime,
+                from_coin.symbol.label("from_coin_symbol"),
+                from_coin.enabled.label("from_coin_enabled"),
+                to_coin.symbol.label("to_coin_symbol"),
+                to_coin.enabled.label("to_coin_enabled"),
+            ]
+        )
+        .select_from(
+            ScoutHistory.__table__.join(Pair.__table__, ScoutHistory.pair_id == Pair.id)
+            .join(from_coin, Pair.from_coin_id == from_coin.symbol)
+            .join(to_coin, Pair.to_coin_id == to_coin.symbol)
+        )
+        .where(Pair.from_coin_id == coin)
+    )
+    return history_response(
+        filter_period(query, ScoutHistory),
+        ScoutHistory,
+        scout_info,
+        lambda query: json_response([scout_info(scout) for scout in fetch_all(query)]),
+    )
 
 
 @app.route("/api/current_coin")
@@ -117,14 +430,16 @@ def current_coin():
 
 @app.route("/api/current_coin_history")
 def current_coin_history():
-    session: Session
-    with db.db_session() as session:
-        query = session.query(CurrentCoin)
-
-        query = filter_period(query, CurrentCoin)
-
-        current_coins: List[CurrentCoin] = query.all()
-        return jsonify([cc.info() for cc in current_coins])
+    query = select([CurrentCoin.datetime, CurrentCoin.id, Coin.symbol, Coin.enabled]).select_from(
+        CurrentCoin.__table__.join(Coin.__table__, CurrentCoin.coin_id == Coin.symbol)
+    )
+    query = ordered_by_time(filter_period(query, CurrentCoin), CurrentCoin)
+    return json_response(
+        [
+            {"datetime": cc_datetime.isoformat(), "coin": coin_info(symbol, enabled)}
+            for cc_datetime, _, symbol, enabled in fetch_all(query)
+        ]
+    )
 
 
 @app.route("/api/coins")
@@ -149,5 +464,13 @@ def handle_my_custom_event(json):
     emit("update", json, namespace="/frontend", broadcast=True)
 
 
+@socketio.on("updates", namespace="/backend")
+def handle_updates(batch):
+    # The bot sends the rows of a table in batches, the frontend gets them one at a time like before
+    for data in batch["data"]:
+        emit("update", {"table": batch["table"], "data": data}, namespace="/frontend", broadcast=True)
+    return True
+
+
 if __name__ == "__main__":
     socketio.run(app, debug=True, port=5123)
@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_exc
+from typing import Awaitable, Callable
+
+from requests.adapters import HTTPAdapter
+
+from .auto_trader import AutoTrader
+from .binance_api_manager import BinanceAPIManager
+from .config import Config
+from .database import Database
+from .logger import Logger
+
+
+class AsyncRuntime:
+    """
+    Runs the trader's periodic jobs as independent asyncio tasks, so a slow one (a scout waiting on its orders, a
+    retried request) doesn't hold back the others. Blocking Binance calls run on a pool of threads sharing a pool of
+    connections, and the periodic database jobs on a single thread of their own
+    """
+
+    def __init__(
+        self,
+        trader: AutoTrader,
+        manager: BinanceAPIManager,
+        db: Database,
+        logger: Logger,
+        config: Config,
+        io_workers=4,
+    ):
+        self.trader = trader
+        self.manager = manager
+        self.db = db
+        self.logger = logger
+        self.config = config
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix="binance-io")
+        # Pruning and saving values and ratios run one at a time rather than contend with each other for SQLite's lock.
+        # Scouts still write their trades, ratios and current coin from the io threads, and may wait on these
+        self.db_executor = ThreadPoolExecutor(1, thread_name_prefix="database")
+        # Keep a connection open for each thread that can talk to Binance at the same time
+        manager.binance_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=io_workers))
+
+    def _in_io(self, func: Callable) -> Callable[[], Awaitable]:
+        async def run():
+            return await asyncio.get_running_loop().run_in_executor(self.io_executor, func)
+
+        return run
+
+    def _in_db(self, func: Callable) -> Callable[[], Awaitable]:
+        async def run():
+            return await asyncio.get_running_loop().run_in_executor(self.db_executor, func)
+
+        return run
+
+    async def _update_values(self):
+        loop = asyncio.get_running_loop()
+        coin_values = await loop.run_in_executor(self.io_executor, self.trader.get_values)
+        await loop.run_in_executor(self.db_executor, self.trader.save_values, coin_values)
+
+    async def _every(self, seconds: float, tag: str, job: Callable[[], Awaitable]):
+        """
+        Run a job every few seconds, counted from the start of its previous run, like the scheduler does
+        """
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + seconds
+        while True:
+            # A run that overran its interval is followed straight away by the next one
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            next_run = loop.time() + seconds
+            try:
+                await job()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.error(f"Error while {tag}...\n{format_exc()}")
+
+    async def run(self):
+        jobs = [
+            (self.config.SCOUT_SLEEP_TIME, "scouting", self._in_io(self.trader.scout)),
+            (60, "updating value history", self._update_values),
+            (60, "pruning scout history", self._in_db(self.db.prune_scout_history)),
+            (60 * 60, "pruning value history", self._in_db(self.db.prune_value_history)),
+            (60, "saving pair ratios", self._in_db(self.db.flush_ratios)),
+            (60 * 60, "logging request metrics", self._in_io(self.manager.log_request_metrics)),
+        ]
+        try:
+            await asyncio.gather(*(self._every(seconds, tag, job) for seconds, tag, job in jobs))
+        finally:
+            # A scout may be waiting on its orders, and writes to the database when they fill: let it finish before the
+            # database is closed. Each job has at most one run in flight, so nothing else is queued
+            self.io_executor.shutdown(wait=True)
+            self.db_executor.shutdown(wait=True)
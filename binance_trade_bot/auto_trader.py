@@ -1,14 +1,17 @@
 import time
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-from sqlalchemy.orm import Session
+import numpy as np
 
 from .binance_api_manager import AllTickers, BinanceAPIManager
 from .config import Config
 from .database import Database
 from .logger import Logger
 from .models import Coin, CoinValue, Pair
+from .rate_limiter import Priority
+from .ratio_engine import RatioEngine
+from .route_engine import RouteEngine
 
 
 class AutoTrader:
@@ -17,6 +20,8 @@ class AutoTrader:
         self.db = database
         self.logger = logger
         self.config = config
+        self.ratio_engine = RatioEngine(binance_manager, config)
+        self.route_engine = RouteEngine(binance_manager, config) if config.ROUTE_HUBS else None
 
     def initialize(self):
         self.initialize_trade_thresholds()
@@ -36,6 +41,9 @@ class AutoTrader:
             )
             return None
 
+        if self.route_engine is not None:
+            return self._transaction_through_route(pair, all_tickers)
+
         direct_pair_price=all_tickers.get_price(pair.from_coin_id + pair.to_coin_id)
         inverse_pair_price=all_tickers.get_price(pair.to_coin_id + pair.from_coin_id)
         if direct_pair_price and float(direct_pair_price)>1e-6:
@@ -78,6 +86,76 @@ class AutoTrader:
         self.logger.info("Couldn't buy, going back to scouting mode...")
         return None
 
+    def _transaction_through_route(self, pair: Pair, all_tickers: AllTickers):
+        """
+        Jump from the source coin to the destination coin along the best route, each trade spending only what the
+        previous one got
+        """
+        route = self.route_engine.get_route(pair.from_coin_id, pair.to_coin_id, all_tickers)
+        if route is None:
+            self.logger.info(f"No route from {pair.from_coin_id} to {pair.to_coin_id}, going back to scouting mode...")
+            return None
+        self.logger.info(f"Jumping from {pair.from_coin_id} to {pair.to_coin_id} through {' -> '.join(route.coins)}")
+
+        coins = {
+            pair.from_coin_id: pair.from_coin,
+            pair.to_coin_id: pair.to_coin,
+            self.config.BRIDGE_SYMBOL: self.config.BRIDGE,
+        }
+        amount = None
+        for hop in route.hops:
+            # Hubs we don't trade stay disabled in the database when the trade log adds them
+            from_coin, to_coin = (
+                coins.get(symbol) or Coin(symbol, symbol in self.config.SUPPORTED_COIN_LIST)
+                for symbol in (hop.from_coin, hop.to_coin)
+            )
+            to_balance = self.manager.get_currency_balance(hop.to_coin)
+            if hop.selling:
+                result = self.manager.sell_alt(from_coin, to_coin, all_tickers, amount)
+            else:
+                result = self.manager.buy_alt(to_coin, from_coin, all_tickers, False, amount)
+            if result is None:
+                self.logger.info(f"Couldn't trade on {hop.symbol}, going back to scouting mode...")
+                if amount is not None:
+                    # Earlier hops went through, and left what they got in a coin we may not scout from
+                    self._return_to_bridge(from_coin, amount, all_tickers)
+                return None
+            # Whatever else we held of the coin isn't part of the jump
+            amount = self.manager.get_currency_balance(hop.to_coin) - to_balance
+            if amount <= 0 and hop is not route.hops[-1]:
+                # Passing no amount on would trade the whole balance of the coin
+                self.logger.warning(
+                    f"Trading on {hop.symbol} didn't add to our {hop.to_coin} balance, stopping the route with "
+                    f"{self.manager.get_currency_balance(hop.to_coin)} {hop.to_coin}"
+                )
+                return None
+
+        last_hop = route.hops[-1]
+        if last_hop.selling:
+            price = all_tickers.get_price(pair.to_coin + self.config.BRIDGE)
+        elif last_hop.from_coin == self.config.BRIDGE_SYMBOL:
+            price = float(result["price"])
+        else:
+            price = float(result["price"]) * all_tickers.get_price(last_hop.from_coin + self.config.BRIDGE_SYMBOL)
+        self.update_trade_threshold(pair.to_coin, price, all_tickers)
+        return result
+
+    def _return_to_bridge(self, coin: Coin, amount: float, all_tickers: AllTickers):
+        """
+        Trade what a route that stopped halfway got of a coin back to the bridge, where bridge_scout picks it up
+        """
+        bridge = self.config.BRIDGE
+        if coin.symbol == bridge.symbol:
+            return
+        self.logger.info(f"Route stopped with {amount} {coin} left over, trading it back to {bridge}")
+        result = None
+        if all_tickers.get_price(coin.symbol + bridge.symbol) is not None:
+            result = self.manager.sell_alt(coin, bridge, all_tickers, amount)
+        elif all_tickers.get_price(bridge.symbol + coin.symbol) is not None:
+            result = self.manager.buy_alt(bridge, coin, all_tickers, False, amount)
+        if result is None:
+            self.logger.warning(f"Couldn't trade {amount} {coin} back to {bridge}, it is left in {coin}")
+
     def update_trade_threshold(self, coin: Coin, coin_price: float, all_tickers: AllTickers):
         """
         Update all the coins with the threshold of buying the current held coin
@@ -88,24 +166,22 @@ class AutoTrader:
             self.logger.info("Skipping update... current coin {} not found".format(coin + self.config.BRIDGE))
             return
 
-        session: Session
-        with self.db.db_session() as session:
-            for pair in session.query(Pair).filter(Pair.to_coin == coin):
-                if pair.from_coin.symbol==self.config.BRIDGE_SYMBOL:
-                    from_coin_price=1
-                else:
-                    from_coin_price = all_tickers.get_price(pair.from_coin + self.config.BRIDGE)
-
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
-                anc_ratio=pair.ratio
-                pair.ratio = from_coin_price / coin_price
+        for pair in self.db.get_pairs_to(coin, only_enabled=False):
+            if pair.from_coin.symbol==self.config.BRIDGE_SYMBOL:
+                from_coin_price=1
+            else:
+                from_coin_price = all_tickers.get_price(pair.from_coin + self.config.BRIDGE)
+
+            if from_coin_price is None:
                 self.logger.info(
-                    "Update "+pair.from_coin.symbol + pair.to_coin.symbol +" Anc:"+str(anc_ratio)+" ratio:"+str(pair.ratio)+" From price:"+str(from_coin_price)+" To "+ str( coin_price)
+                    "Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE)
                 )
+                continue
+            anc_ratio=pair.ratio
+            self.db.set_pair_ratio(pair, from_coin_price / coin_price)
+            self.logger.info(
+                "Update "+pair.from_coin.symbol + pair.to_coin.symbol +" Anc:"+str(anc_ratio)+" ratio:"+str(pair.ratio)+" From price:"+str(from_coin_price)+" To "+ str( coin_price)
+            )
 
     def initialize_trade_thresholds(self):
         """
@@ -113,33 +189,32 @@ class AutoTrader:
         """
         all_tickers = self.manager.get_all_market_tickers()
 
-        session: Session
-        with self.db.db_session() as session:
-            for pair in session.query(Pair).filter(Pair.ratio.is_(None)).all():
-                if not pair.from_coin.enabled or not pair.to_coin.enabled:
-                    continue
-                self.logger.info(f"Initializing {pair.from_coin} vs {pair.to_coin}")
+        for pair in self.db.get_pairs(only_enabled=False):
+            if pair.ratio is not None or not pair.from_coin.enabled or not pair.to_coin.enabled:
+                continue
+            self.logger.info(f"Initializing {pair.from_coin} vs {pair.to_coin}")
 
-                if pair.from_coin.symbol==self.config.BRIDGE_SYMBOL:
-                    from_coin_price=1
-                else:
-                    from_coin_price = all_tickers.get_price(pair.from_coin + self.config.BRIDGE)
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
-                if pair.to_coin.symbol==self.config.BRIDGE_SYMBOL:
-                    to_coin_price=1
-                else:
-                    to_coin_price = all_tickers.get_price(pair.to_coin + self.config.BRIDGE)
-                if to_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE)
-                    )
-                    continue
+            if pair.from_coin.symbol==self.config.BRIDGE_SYMBOL:
+                from_coin_price=1
+            else:
+                from_coin_price = all_tickers.get_price(pair.from_coin + self.config.BRIDGE)
+            if from_coin_price is None:
+                self.logger.info(
+                    "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
+                )
+                continue
+            if pair.to_coin.symbol==self.config.BRIDGE_SYMBOL:
+                to_coin_price=1
+            else:
+                to_coin_price = all_tickers.get_price(pair.to_coin + self.config.BRIDGE)
+            if to_coin_price is None:
+                self.logger.info(
+                    "Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE)
+                )
+                continue
 
-                pair.ratio = from_coin_price / to_coin_price
+            self.db.set_pair_ratio(pair, from_coin_price / to_coin_price)
+        self.db.flush_ratios()
 
     def scout(self):
         """
@@ -151,77 +226,116 @@ class AutoTrader:
         """
         Given a coin, get the current price ratio for every other enabled coin
         """
-        ratio_dict: Dict[Pair, float] = {}
-        current_balances=self.manager.get_balances()
-        current_balances_dict={d['asset']:float(d['free']) for d in current_balances if float(d['free'])>0}
-
-
-        for pair in self.db.get_pairs_from(coin):
-            min_amount=self.config.MIN_AMOUNT
+        return self._get_all_ratios({coin: coin_price_bridge}, self.db.get_pairs_from(coin), all_tickers)[coin.symbol]
+
+    def _get_all_ratios(
+        self,
+        coin_prices: Dict[Coin, float],
+        pairs: List[Pair],
+        all_tickers: AllTickers,
+        current_balances_dict: Dict[str, float] = None,
+    ) -> Dict[str, Dict[Pair, float]]:
+        """
+        Given coins and their bridge price, get the current price ratio for every other enabled coin, for all of them in
+        one pass of the ratio engine
+        """
+        if current_balances_dict is None:
+            current_balances=self.manager.get_balances()
+            current_balances_dict={d['asset']:float(d['free']) for d in current_balances if float(d['free'])>0}
+
+        engine = self.ratio_engine
+        engine.set_coins(
+            set(self.config.SUPPORTED_COIN_LIST).union(
+                (coin.symbol for coin in coin_prices), (pair.to_coin_id for pair in pairs)
+            )
+        )
+        engine.load_prices(all_tickers)
+        rows = {coin.symbol: row for row, coin in enumerate(coin_prices)}
+        engine_rows = [engine.index[symbol] for symbol in rows]
+        held = engine.get_held(current_balances_dict)
+        if self.route_engine is not None:
+            # Routes are scored at ticker prices, order books or not
+            self.route_engine.set_coins(engine.symbols)
+            self.route_engine.load_prices(all_tickers)
+            scout = self.route_engine.scout(engine_rows, engine.get_ratios(pairs)[engine_rows], held)
+        elif self.manager.order_books is not None:
+            scout = engine.scout_order_books(
+                engine_rows,
+                np.array(list(coin_prices.values()), dtype=float),
+                [
+                    self._get_trade_amount(coin, coin_price, current_balances_dict)
+                    for coin, coin_price in coin_prices.items()
+                ],
+                self.manager.order_books,
+                engine.get_ratios(pairs)[engine_rows],
+                held,
+            )
+        else:
+            scout = engine.scout(
+                engine_rows,
+                np.array(list(coin_prices.values()), dtype=float),
+                engine.get_ratios(pairs)[engine_rows],
+                held,
+            )
 
-            if pair.to_coin.symbol==self.config.BRIDGE_SYMBOL:
-                optional_coin_price=1
-            else:
-                optional_coin_price=all_tickers.get_price(pair.to_coin.symbol+self.config.BRIDGE_SYMBOL)
-
-            if pair.to_coin.symbol in current_balances_dict:
-                min_to_ignore=self.config.MIN_AMOUNT
-                if pair.to_coin.symbol=='BNB':
-                    min_to_ignore+=self.config.MIN_BNB
-                if current_balances_dict[pair.to_coin.symbol]*optional_coin_price > min_to_ignore:
-                    continue
-            pair_exists = (all_tickers.get_price(pair.from_coin + pair.to_coin),
-                           all_tickers.get_price(pair.to_coin + pair.from_coin))
-            if pair_exists[0] and pair_exists[0]>1e-06:
-                coin_price = pair_exists[0]
-                optional_coin_price = 1
-                transaction_fee = self.manager.get_fee(pair.from_coin, pair.to_coin, True)
-            elif pair_exists[1] and pair_exists[1]>1e-06:
-                coin_price = 1
-                optional_coin_price = pair_exists[1]
-                transaction_fee = self.manager.get_fee(pair.to_coin, pair.from_coin, False)
-            else:
-                if self.config.ONLY_DIRECT_PAIRS:
-                    continue
-                coin_price = coin_price_bridge
-                optional_coin_price = all_tickers.get_price(pair.to_coin + self.config.BRIDGE)
-                transaction_fee = self.manager.get_fee(pair.from_coin, self.config.BRIDGE, True) + self.manager.get_fee(
-                    pair.to_coin, self.config.BRIDGE, False
-                )
+        all_ratios: Dict[str, Dict[Pair, float]] = {symbol: {} for symbol in rows}
+        for pair in pairs:
+            if pair.from_coin_id not in rows:
+                continue
+            row = rows[pair.from_coin_id]
+            column = engine.index[pair.to_coin_id]
+            if held[column]:
+                continue
 
-            if optional_coin_price is None:
+            optional_coin_price = scout.optional_coin_prices[row, column]
+            if not optional_coin_price > 0:
                 self.logger.info(
                     "Skipping scouting... optional coin {} not found".format(pair.to_coin + self.config.BRIDGE)
                 )
                 continue
 
-            self.db.log_scout(pair, pair.ratio, coin_price, optional_coin_price)
+            margin = scout.margins[row, column]
+            if np.isnan(margin):
+                continue
 
-            # Obtain (current coin)/(optional coin)
-            coin_opt_coin_ratio = coin_price / optional_coin_price
+            self.db.log_scout(pair, pair.ratio, float(scout.coin_prices[row, column]), float(optional_coin_price))
+            all_ratios[pair.from_coin_id][pair] = float(margin)
+        return all_ratios
 
-            ratio_dict[pair] = (
-                                       coin_opt_coin_ratio - transaction_fee * self.config.SCOUT_MULTIPLIER * coin_opt_coin_ratio
-                               ) - pair.ratio
-        return ratio_dict
+    def _get_trade_amount(self, coin: Coin, coin_price: float, current_balances_dict: Dict[str, float]) -> float:
+        """
+        Quantity of a coin a jump from it would sell: its balance, down to the max amount like when selling it
+        """
+        amount = current_balances_dict.get(coin.symbol, 0)
+        if self.config.MAX_AMOUNT and amount * coin_price > self.config.MAX_AMOUNT + self.config.MIN_AMOUNT:
+            amount = self.config.MAX_AMOUNT / coin_price
+        return amount
 
     def _jump_to_best_coin(self, coin: Coin, coin_price: float, all_tickers: AllTickers):
         """
         Given a coin, search for a coin to jump to
         """
         ratio_dict = self._get_ratios(coin, coin_price, all_tickers)
-        best_ratio=max(ratio_dict,key=ratio_dict.get)
+        best_pair = self._get_best_pair(coin, ratio_dict)
+        if best_pair is not None:
+            self.transaction_through_bridge(best_pair, all_tickers)
         # keep only ratios bigger than zero
-        self.logger.info(f"BEST: {best_ratio}  {ratio_dict[best_ratio]}" )
-        ratio_dict = {k: v for k, v in ratio_dict.items() if v > 0}
+        return {k: v for k, v in ratio_dict.items() if v > 0}
 
-        # if we have any viable options, pick the one with the biggest ratio
-        if ratio_dict:
-            best_pair = max(ratio_dict, key=ratio_dict.get)
-            self.logger.info(f"Will be jumping from {coin} to {best_pair.to_coin_id}")
+    def _get_best_pair(self, coin: Coin, ratio_dict: Dict[Pair, float]) -> Optional[Pair]:
+        """
+        Given the ratios of a coin, pick the pair worth jumping through, if any
+        """
+        if not ratio_dict:
+            return None
+        best_pair = max(ratio_dict, key=ratio_dict.get)
+        self.logger.info(f"BEST: {best_pair}  {ratio_dict[best_pair]}" )
 
-            self.transaction_through_bridge(best_pair, all_tickers)
-        return ratio_dict
+        # if we have any viable options, pick the one with the biggest ratio
+        if ratio_dict[best_pair] <= 0:
+            return None
+        self.logger.info(f"Will be jumping from {coin} to {best_pair.to_coin_id}")
+        return best_pair
 
     def bridge_scout(self):
         """
@@ -230,13 +344,12 @@ class AutoTrader:
         bridge_balance = self.manager.get_currency_balance(self.config.BRIDGE.symbol)
         all_tickers = self.manager.get_all_market_tickers()
 
-        for coin in self.db.get_coins():
-            current_coin_price = all_tickers.get_price(coin + self.config.BRIDGE)
+        coin_prices = {coin: all_tickers.get_price(coin + self.config.BRIDGE) for coin in self.db.get_coins()}
+        coin_prices = {coin: price for coin, price in coin_prices.items() if price is not None}
+        all_ratios = self._get_all_ratios(coin_prices, self.db.get_pairs(), all_tickers)
 
-            if current_coin_price is None:
-                continue
-
-            ratio_dict = self._get_ratios(coin, current_coin_price, all_tickers)
+        for coin in coin_prices:
+            ratio_dict = all_ratios[coin.symbol]
             if not any(v > 0 for v in ratio_dict.values()):
                 # There will only be one coin where all the ratios are negative. When we find it, buy it if we can
                 if bridge_balance > self.manager.get_min_notional(coin.symbol, self.config.BRIDGE.symbol):
@@ -249,48 +362,56 @@ class AutoTrader:
         """
         Log current value state of all altcoi n balances against BTC and USDT in DB.
         """
+        self.save_values(self.get_values())
+
+    def get_values(self) -> List[CoinValue]:
+        """
+        Value the balance of every coin against BTC and USDT, without writing anything to the DB
+        """
         print("Logging values...")
-        gottickers=False
-        while not gottickers:
-            try:
-                all_ticker_values = self.manager.get_all_market_tickers()
-                gottickers=True
-            except:
-                time.sleep(5)
+        # Value logging can wait, trading requests go first when we get close to the rate limit
+        with self.manager.request_priority(Priority.LOW):
+            gottickers=False
+            while not gottickers:
+                try:
+                    all_ticker_values = self.manager.get_all_market_tickers()
+                    gottickers=True
+                except:
+                    time.sleep(5)
+            balances=self.manager.get_balances()
 
         now = datetime.now()
 
-        session: Session
-        bridge_symbol=self.config.BRIDGE_SYMBOL
-        with self.db.db_session() as session:
-            coins: List[Coin] = session.query(Coin).all()
-            balances=self.manager.get_balances()
-            balances_dict={d['asset']:float(d['free'])+float(d['locked']) for d in balances if float(d['free'])+float(d['locked'])>0}
-            total_balance_usd=total_balance_btc=0
-            for coin in coins:
-                btc_value=usd_value=0
-                if coin.symbol not in balances_dict:
-                    continue
-                balance = balances_dict[coin.symbol]
-                if  coin.symbol=='USDT':
-                    usd_value=1
-                    btc_value = 1 / all_ticker_values.get_price('BTCUSDT')
-                elif coin.symbol=='BTC':
-                    btc_value=1
-                    usd_value=all_ticker_values.get_price('BTCUSDT')
-                else:
-                    usd_value = all_ticker_values.get_price(coin + 'USDT')
-                    btc_value = all_ticker_values.get_price(coin + 'BTC')
-
-                btc_price=all_ticker_values.get_price('BTCUSDT')
-                if usd_value and btc_value:
-                    self.logger.info(
-                        f"coin: {coin.symbol} price: USDT {usd_value} BTC {btc_value} Balance: USDT {usd_value * balance} BTC {btc_value * balance}"
-                    )
-                    total_balance_btc+=btc_value * balance
-                    total_balance_usd+=usd_value * balance
-                if coin.symbol!=self.config.BRIDGE_SYMBOL:
-                    cv = CoinValue(coin, balance, usd_value, btc_value, datetime=now)
-                    session.add(cv)
-                #self.db.send_update(cv)
-            self.logger.info(f"Total balance USDT: {total_balance_usd} BTC: {total_balance_btc} BTC price: {btc_price}" )
+        coin_values: List[CoinValue] = []
+        coins: List[Coin] = self.db.get_coins(only_enabled=False)
+        balances_dict={d['asset']:float(d['free'])+float(d['locked']) for d in balances if float(d['free'])+float(d['locked'])>0}
+        total_balance_usd=total_balance_btc=0
+        for coin in coins:
+            btc_value=usd_value=0
+            if coin.symbol not in balances_dict:
+                continue
+            balance = balances_dict[coin.symbol]
+            if  coin.symbol=='USDT':
+                usd_value=1
+                btc_value = 1 / all_ticker_values.get_price('BTCUSDT')
+            elif coin.symbol=='BTC':
+                btc_value=1
+                usd_value=all_ticker_values.get_price('BTCUSDT')
+            else:
+                usd_value = all_ticker_values.get_price(coin + 'USDT')
+                btc_value = all_ticker_values.get_price(coin + 'BTC')
+
+            btc_price=all_ticker_values.get_price('BTCUSDT')
+            if usd_value and btc_value:
+                self.logger.info(
+                    f"coin: {coin.symbol} price: USDT {usd_value} BTC {btc_value} Balance: USDT {usd_value * balance} BTC {btc_value * balance}"
+                )
+                total_balance_btc+=btc_value * balance
+                total_balance_usd+=usd_value * balance
+            if coin.symbol!=self.config.BRIDGE_SYMBOL:
+                coin_values.append(CoinValue(coin, balance, usd_value, btc_value, datetime=now))
+        self.logger.info(f"Total balance USDT: {total_balance_usd} BTC: {total_balance_btc} BTC price: {btc_price}" )
+        return coin_values
+
+    def save_values(self, coin_values: List[CoinValue]):
+        self.db.save_values(coin_values)
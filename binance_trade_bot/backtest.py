@@ -1,17 +1,32 @@
+import math
 from datetime import datetime, timedelta
 from traceback import format_exc
 from typing import Dict
 
-from sqlitedict import SqliteDict
+import numpy as np
 
+from .auto_trader import AutoTrader
 from .binance_api_manager import AllTickers, BinanceAPIManager
 from .config import Config
 from .database import Database
+from .kline_store import KlineStore, minute_of
 from .logger import Logger
 from .models import Coin, Pair
 from .strategies import get_strategy
 
-cache = SqliteDict("data/backtest_cache.db")
+kline_store = KlineStore("data/klines")
+# Fee charged on every simulated trade
+BACKTEST_FEE = 0.0075
+
+
+class OfflineClient:  # pylint: disable=too-few-public-methods
+    """
+    Stands in for the Binance client when backtesting offline, so anything that would still reach the network fails
+    loudly instead
+    """
+
+    def __getattr__(self, name):
+        raise RuntimeError(f"Backtesting offline, can't call Binance ({name}). Prefetch the data first")
 
 
 class FakeAllTickers(AllTickers):  # pylint: disable=too-few-public-methods
@@ -30,8 +45,10 @@ class MockBinanceManager(BinanceAPIManager):
         logger: Logger,
         start_date: datetime = None,
         start_balances: Dict[str, float] = None,
+        offline: bool = False,
     ):
-        super().__init__(config, db, logger)
+        super().__init__(config, db, logger, OfflineClient() if offline else None)
+        self.offline = offline
         self.config = config
         self.datetime = start_date or datetime(2021, 1, 1)
         self.balances = start_balances or {config.BRIDGE.symbol: 100}
@@ -46,29 +63,28 @@ class MockBinanceManager(BinanceAPIManager):
         return FakeAllTickers(self)
 
     def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):
-        return 0.0075
+        return BACKTEST_FEE
 
     def get_market_ticker_price(self, ticker_symbol: str):
         """
         Get ticker price of a specific coin
         """
-        target_date = self.datetime.strftime("%d %b %Y %H:%M:%S")
-        key = f"{ticker_symbol} - {target_date}"
-        val = cache.get(key, None)
-        if val is None:
+        minute = minute_of(self.datetime)
+        val = kline_store.get_price(ticker_symbol, minute)
+        if val is None and not self.offline and not kline_store.read_only:
+            target_date = self.datetime.strftime("%d %b %Y %H:%M:%S")
             end_date = self.datetime + timedelta(minutes=1000)
             if end_date > datetime.now():
                 end_date = datetime.now()
             end_date = end_date.strftime("%d %b %Y %H:%M:%S")
             self.logger.info(f"Fetching prices for {ticker_symbol} between {self.datetime} and {end_date}")
+            prices = {}
             for result in self.binance_client.get_historical_klines(
                 ticker_symbol, "1m", target_date, end_date, limit=1000
             ):
-                date = datetime.utcfromtimestamp(result[0] / 1000).strftime("%d %b %Y %H:%M:%S")
-                price = float(result[1])
-                cache[f"{ticker_symbol} - {date}"] = price
-            cache.commit()
-            val = cache.get(key, None)
+                prices[result[0] // 60000] = float(result[1])
+            kline_store.set_price_dict(ticker_symbol, prices)
+            val = kline_store.get_price(ticker_symbol, minute)
         return val
 
     def get_currency_balance(self, currency_symbol: str):
@@ -77,11 +93,23 @@ class MockBinanceManager(BinanceAPIManager):
         """
         return self.balances.get(currency_symbol, 0)
 
-    def buy_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers):
+    def get_balances(self):
+        return [{"asset": symbol, "free": balance, "locked": 0} for symbol, balance in self.balances.items()]
+
+    def buy_alt(
+        self,
+        origin_coin: Coin,
+        target_coin: Coin,
+        all_tickers: AllTickers,
+        marketBuy: bool = False,
+        amount: float = None,
+    ):  # pylint: disable=unused-argument
         origin_symbol = origin_coin.symbol
         target_symbol = target_coin.symbol
 
         target_balance = self.get_currency_balance(target_symbol)
+        if amount is not None:
+            target_balance = min(target_balance, amount)
         from_coin_price = all_tickers.get_price(origin_symbol + target_symbol)
 
         order_quantity = self._buy_quantity(origin_symbol, target_symbol, target_balance, from_coin_price)
@@ -96,11 +124,13 @@ class MockBinanceManager(BinanceAPIManager):
         )
         return {"price": from_coin_price}
 
-    def sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers):
+    def sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers, amount: float = None):
         origin_symbol = origin_coin.symbol
         target_symbol = target_coin.symbol
 
         origin_balance = self.get_currency_balance(origin_symbol)
+        if amount is not None:
+            origin_balance = min(origin_balance, amount)
         from_coin_price = all_tickers.get_price(origin_symbol + target_symbol)
 
         order_quantity = self._sell_quantity(origin_symbol, target_symbol, origin_balance)
@@ -141,6 +171,75 @@ class MockDatabase(Database):
     def log_scout(self, pair: Pair, target_ratio: float, current_coin_price: float, other_coin_price: float):
         pass
 
+    def send_update(self, model):
+        pass
+
+
+class FastForward:
+    """
+    Finds out from the stored prices how many of the next scouts of the default strategy won't jump, so the backtest
+    can skip them. Until the next jump, the current coin, the pair ratios and the balances stay the same, so whether a
+    scout jumps only depends on the prices at its minute
+    """
+
+    # Number of scouts checked at once
+    LOOKAHEAD = 1440
+
+    def __init__(self, trader: AutoTrader, manager: MockBinanceManager, interval: int):
+        self.trader = trader
+        self.manager = manager
+        self.interval = interval
+
+    def _get_series(self, symbol: str, start: int, steps: int) -> np.ndarray:
+        return kline_store.get_prices(symbol, start, start + steps * self.interval)[:: self.interval]
+
+    def idle_steps(self, max_steps: int) -> int:
+        """
+        Count how many scouts in a row, from the next one and up to max_steps, would leave everything unchanged
+        """
+        config = self.trader.config
+        current_coin = self.trader.db.get_current_coin()
+        pairs = self.trader.db.get_pairs_from(current_coin)
+        balances = {
+            balance["asset"]: float(balance["free"])
+            for balance in self.manager.get_balances()
+            if float(balance["free"]) > 0
+        }
+
+        # Same coins as the scout loads the ratio engine with
+        engine = self.trader.ratio_engine
+        engine.set_coins(
+            set(config.SUPPORTED_COIN_LIST).union([current_coin.symbol], (pair.to_coin_id for pair in pairs))
+        )
+        row = engine.index[current_coin.symbol]
+        ratios = engine.get_ratios(pairs)[row]
+
+        start = minute_of(self.manager.datetime)
+        idle = 0
+        while idle < max_steps:
+            steps = min(self.LOOKAHEAD, max_steps - idle)
+            first = start + idle * self.interval
+            coin_prices = self._get_series(current_coin.symbol + config.BRIDGE_SYMBOL, first, steps)
+            direct = np.column_stack(
+                [self._get_series(current_coin.symbol + symbol, first, steps) for symbol in engine.symbols]
+            )
+            inverse = np.column_stack(
+                [self._get_series(symbol + current_coin.symbol, first, steps) for symbol in engine.symbols]
+            )
+            bridge_prices = np.column_stack(
+                [self._get_series(symbol + config.BRIDGE_SYMBOL, first, steps) for symbol in engine.symbols]
+            )
+            held = engine.get_held(balances, bridge_prices)
+            margins = engine.scout_series(row, direct, inverse, coin_prices, bridge_prices, ratios, held).margins
+
+            # A scout jumps if any margin is positive, unless it can't price the current coin
+            with np.errstate(invalid="ignore"):
+                jumps = np.flatnonzero((margins > 0).any(axis=1) & ~np.isnan(coin_prices))
+            if len(jumps) > 0:
+                return idle + int(jumps[0])
+            idle += steps
+        return idle
+
 
 def backtest(
     start_date: datetime = None,
@@ -150,10 +249,17 @@ def backtest(
     start_balances: Dict[str, float] = None,
     starting_coin: str = None,
     config: Config = None,
+    logger: Logger = None,
+    offline: bool = False,
+    fast_forward: bool = False,
 ):
     """
 
     :param config: Configuration object to use
+    :param logger: Logger to use. Default: a new "backtesting" logger
+    :param offline: Only use prefetched data, without connecting to Binance. Missing prices are skipped
+    :param fast_forward: Skip straight over the scouts that can't jump, with the same results. Needs offline and the
+        default strategy
     :param start_date: Date to  backtest from
     :param end_date: Date to backtest up to
     :param interval: Number of virtual minutes between each scout
@@ -164,14 +270,14 @@ def backtest(
     :return: The final coin balances
     """
     config = config or Config()
-    logger = Logger("backtesting", enable_notifications=False)
+    logger = logger or Logger("backtesting", enable_notifications=False)
 
     end_date = end_date or datetime.today()
 
     db = MockDatabase(logger, config)
     db.create_database()
     db.set_coins(config.SUPPORTED_COIN_LIST)
-    manager = MockBinanceManager(config, db, logger, start_date, start_balances)
+    manager = MockBinanceManager(config, db, logger, start_date, start_balances, offline)
 
     starting_coin = db.get_coin(starting_coin or config.SUPPORTED_COIN_LIST[0])
     if manager.get_currency_balance(starting_coin.symbol) == 0:
@@ -185,11 +291,29 @@ def backtest(
     trader = strategy(manager, db, logger, config)
     trader.initialize()
 
+    forwarder = None
+    if fast_forward:
+        if offline and config.STRATEGY == "default":
+            forwarder = FastForward(trader, manager, interval)
+        else:
+            logger.warning("Fast forward needs offline mode and the default strategy, scouting every interval")
+
     yield manager
 
     n = 1
     try:
         while manager.datetime < end_date:
+            if forwarder is not None:
+                # Don't skip past the end date, or past the next time the manager gets yielded
+                remaining = math.ceil((end_date - manager.datetime) / timedelta(minutes=interval))
+                idle = forwarder.idle_steps(min(remaining, -n % yield_interval + 1))
+                if idle > 0:
+                    manager.increment(interval * idle)
+                    n += idle - 1
+                    if n % yield_interval == 0:
+                        yield manager
+                    n += 1
+                    continue
             try:
                 trader.scout()
             except Exception:  # pylint: disable=broad-except
@@ -200,5 +324,4 @@ def backtest(
             n += 1
     except KeyboardInterrupt:
         pass
-    cache.close()
     return manager
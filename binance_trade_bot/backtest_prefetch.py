@@ -0,0 +1,150 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+from binance.client import Client
+
+from .backtest import kline_store
+from .config import Config
+from .exchange_info import ExchangeInfo
+from .kline_store import KlineStore, minute_of
+from .logger import Logger
+from .rate_limiter import RateLimitedClient, RateLimiter
+
+KLINES_PER_REQUEST = 1000
+
+
+def create_client(config: Config, api_url: str = None) -> RateLimitedClient:
+    """
+    Create a Binance client, talking to api_url instead of Binance when set (e.g. a local fake server)
+    """
+    return RateLimitedClient(
+        config.BINANCE_API_KEY, config.BINANCE_API_SECRET_KEY, tld=config.BINANCE_TLD, api_url=api_url
+    )
+
+
+def get_backtest_symbols(config: Config, listed_symbols: Set[str]) -> List[str]:
+    """
+    Every listed symbol a backtest of the supported coin list can ask the price of: each coin against the bridge and
+    against BTC, the direct pairs between coins, and BTC against the bridge
+    """
+    coins = config.SUPPORTED_COIN_LIST
+    symbols = {coin + config.BRIDGE_SYMBOL for coin in coins}
+    symbols |= {coin + "BTC" for coin in coins}
+    symbols |= {from_coin + to_coin for from_coin in coins for to_coin in coins if from_coin != to_coin}
+    symbols.add("BTC" + config.BRIDGE_SYMBOL)
+    return sorted(symbols & listed_symbols)
+
+
+def get_missing_windows(store: KlineStore, symbols: Iterable[str], start: int, end: int) -> List[Tuple[str, int, int]]:
+    """
+    Split [start, end) into request sized windows, keeping the ones with minutes we have no price for, unless they were
+    downloaded already and Binance had no price for them
+    """
+    windows = []
+    for symbol in symbols:
+        prices = store.get_prices(symbol, start, end)
+        fetched = store.get_fetched(symbol)
+        for window_start in range(start, end, KLINES_PER_REQUEST):
+            window_end = min(window_start + KLINES_PER_REQUEST, end)
+            if not np.isnan(prices[window_start - start : window_end - start]).any():
+                continue
+            if any(low <= window_start and window_end <= high for low, high in fetched):
+                continue
+            windows.append((symbol, window_start, window_end))
+    return windows
+
+
+def fetch_window(client: RateLimitedClient, symbol: str, start: int, end: int) -> Dict[int, float]:
+    """
+    Get the open price of every minute in [start, end) that Binance has a kline for
+    """
+    klines = client.get_klines(
+        symbol=symbol,
+        interval=Client.KLINE_INTERVAL_1MINUTE,
+        startTime=start * 60000,
+        endTime=end * 60000 - 1,
+        limit=KLINES_PER_REQUEST,
+    )
+    return {kline[0] // 60000: float(kline[1]) for kline in klines}
+
+
+def prefetch(
+    config: Config,
+    start_date: datetime,
+    end_date: datetime,
+    client: RateLimitedClient,
+    logger: Logger,
+    store: KlineStore = kline_store,
+    workers: int = 8,
+    weight_share: float = 0.5,
+) -> Dict[str, int]:
+    """
+    Download every price a backtest of the supported coin list can need between two dates into the kline store, along
+    with the exchange info, so the backtest can then run offline. Minutes that were downloaded before, whether Binance
+    had a price for them or not, aren't downloaded again
+
+    :param weight_share: Share of the request weight limit of the IP to use, to leave room for a bot running on it
+    :return: The number of prices downloaded per symbol
+    """
+    exchange_info = ExchangeInfo(client, logger).refresh()
+
+    weight_limit = next(
+        (
+            limit["limit"] / limit.get("intervalNum", 1)
+            for limit in exchange_info.get("rateLimits", [])
+            if limit["rateLimitType"] == "REQUEST_WEIGHT" and limit["interval"] == "MINUTE"
+        ),
+        1200,
+    )
+    # The client retries rate limited requests itself, this keeps them from happening in the first place
+    client.limiter = RateLimiter(weight_limit * weight_share)
+
+    listed_symbols = {symbol["symbol"] for symbol in exchange_info["symbols"]}
+    symbols = get_backtest_symbols(config, listed_symbols)
+    end_date = min(end_date, datetime.utcnow())
+    windows = get_missing_windows(store, symbols, minute_of(start_date), minute_of(end_date))
+    logger.info(f"Fetching {len(windows)} windows of prices for {len(symbols)} symbols")
+
+    fetched = {symbol: 0 for symbol in symbols}
+    # Windows downloaded since their ranges were last recorded in the store, by symbol
+    fetched_windows: Dict[str, List[Tuple[int, int]]] = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_window, client, *window): window for window in windows}
+            for done, future in enumerate(as_completed(futures), 1):
+                symbol, start, end = futures[future]
+                prices = future.result()
+                # The store isn't thread safe, so all writes happen here
+                store.set_price_dict(symbol, prices)
+                fetched[symbol] += len(prices)
+                fetched_windows.setdefault(symbol, []).append((start, end))
+                if done % 100 == 0:
+                    logger.info(f"Fetched {done}/{len(windows)} windows")
+    finally:
+        # Recorded only once their prices are stored, so an interrupted prefetch resumes where it stopped
+        for symbol, symbol_windows in fetched_windows.items():
+            store.add_fetched(symbol, symbol_windows)
+    logger.info(f"Binance requests:\n{client.metrics.summary()}", notification=False)
+    return fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the prices a backtest needs, so it can run offline")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2021, 1, 1))
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.utcnow())
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent downloads")
+    parser.add_argument("--api-url", help="Binance API URL to use instead of the real one, e.g. a local fake server")
+    args = parser.parse_args()
+
+    config = Config()
+    logger = Logger("backtest_prefetch", enable_notifications=False)
+    client = create_client(config, args.api_url)
+    for symbol, count in prefetch(config, args.start, args.end, client, logger, workers=args.workers).items():
+        logger.info(f"{symbol}: {count} prices fetched")
+
+
+if __name__ == "__main__":
+    main()
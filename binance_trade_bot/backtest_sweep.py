@@ -0,0 +1,133 @@
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List
+
+from .backtest import backtest, kline_store
+from .config import Config
+from .logger import Logger
+from .models import Coin
+
+# Logger of the current worker process, so runs in the same process don't stack handlers on the same logger
+worker_logger: Logger = None
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Every combination of the values in a parameter grid, e.g. {"A": [1, 2], "B": [3]} -> [{A: 1, B: 3}, {A: 2, B: 3}]
+    """
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def apply_overrides(config: Config, overrides: Dict[str, Any]):
+    for name, value in overrides.items():
+        if not hasattr(config, name):
+            raise ValueError(f"Unknown config setting {name}")
+        setattr(config, name, value)
+    if "BRIDGE_SYMBOL" in overrides:
+        config.BRIDGE = Coin(config.BRIDGE_SYMBOL, False)
+
+
+def _init_worker():
+    global worker_logger  # pylint: disable=global-statement
+    worker_logger = Logger("backtest_sweep", enable_notifications=False)
+    # Workers only read prices, missing ones have to be fetched before the sweep
+    kline_store.read_only = True
+
+
+def _run(overrides: Dict[str, Any], backtest_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    config = Config()
+    apply_overrides(config, overrides)
+    started = time.perf_counter()
+
+    manager = None
+    start_values = None
+    for manager in backtest(config=config, logger=worker_logger, offline=True, **backtest_kwargs):
+        if start_values is None:
+            start_values = manager.collate_coins("BTC"), manager.collate_coins(config.BRIDGE.symbol)
+    btc_value, bridge_value = manager.collate_coins("BTC"), manager.collate_coins(config.BRIDGE.symbol)
+
+    return {
+        **{name: " ".join(value) if isinstance(value, list) else value for name, value in overrides.items()},
+        "btc_value": btc_value,
+        "btc_diff": (btc_value - start_values[0]) / start_values[0] if start_values[0] else None,
+        "bridge_value": bridge_value,
+        "bridge_diff": (bridge_value - start_values[1]) / start_values[1] if start_values[1] else None,
+        "balances": " ".join(f"{symbol}={balance}" for symbol, balance in manager.balances.items() if balance),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+def sweep(grid: Dict[str, List[Any]], processes: int = None, **backtest_kwargs) -> List[Dict[str, Any]]:
+    """
+    Backtest every combination of a parameter grid, spread over a pool of processes
+
+    :param grid: Config setting -> list of values to try, e.g. {"SCOUT_MULTIPLIER": [3, 5, 8]}
+    :param processes: Number of worker processes. Default: one per CPU
+    :param backtest_kwargs: Passed on to each backtest() run: start_date, end_date, interval, ...
+
+    :return: One row per combination, in grid order, with the final BTC and bridge values
+    """
+    combinations = expand_grid(grid)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+        return list(executor.map(_run, combinations, itertools.repeat(backtest_kwargs, len(combinations)), chunksize=1))
+
+
+def write_table(rows: List[Dict[str, Any]], file):
+    writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def _parse_param(config: Config, param: str):
+    """
+    Parse NAME=VALUE,VALUE,... into the setting name and its values, converted to the type of the current setting
+    """
+    name, _, values = param.partition("=")
+    if not hasattr(config, name):
+        raise argparse.ArgumentTypeError(f"Unknown config setting {name}")
+    current = getattr(config, name)
+    if isinstance(current, list):
+        return name, [value.split() for value in values.split(",")]
+    return name, [type(current)(value) for value in values.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest every combination of a set of config settings")
+    parser.add_argument(
+        "--param",
+        action="append",
+        required=True,
+        help='NAME=VALUE,VALUE,... e.g. SCOUT_MULTIPLIER=3,5,8 or "SUPPORTED_COIN_LIST=ADA XLM EOS,ADA XLM"',
+    )
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2021, 1, 1))
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.now())
+    parser.add_argument("--interval", type=int, default=1, help="Virtual minutes between each scout")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="CSV file to write the results to. Default: standard output")
+    args = parser.parse_args()
+
+    config = Config()
+    grid = dict(_parse_param(config, param) for param in args.param)
+    rows = sweep(
+        grid,
+        args.processes,
+        start_date=args.start,
+        end_date=args.end,
+        interval=args.interval,
+        yield_interval=sys.maxsize,
+    )
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_table(rows, f)
+    else:
+        write_table(rows, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
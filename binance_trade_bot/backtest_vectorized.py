@@ -0,0 +1,258 @@
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .backtest import BACKTEST_FEE, OfflineClient, kline_store
+from .binance_api_manager import get_tick
+from .config import Config
+from .exchange_info import ExchangeInfo
+from .kline_store import KlineStore, minute_of
+from .models import Coin
+from .ratio_engine import RatioEngine
+
+
+class VectorizedBacktest:
+    """
+    Runs the default strategy straight over the stored price series, without the database, the trader or the mock
+    manager. Scouts are evaluated many minutes at a time, and only the jumps are simulated one by one, the same way
+    backtest() does them. Only uses prefetched data, like backtest(offline=True)
+    """
+
+    # Number of scouts evaluated at once
+    LOOKAHEAD = 1440
+
+    def __init__(
+        self,
+        config: Config,
+        start_date: datetime = None,
+        end_date: datetime = None,
+        interval=1,
+        start_balances: Dict[str, float] = None,
+        starting_coin: str = None,
+        store: KlineStore = kline_store,
+    ):
+        self.config = config
+        self.start_date = start_date or datetime(2021, 1, 1)
+        self.interval = interval
+        self.store = store
+        self.steps = max(0, math.ceil(((end_date or datetime.today()) - self.start_date) / timedelta(minutes=interval)))
+        self.step = 0
+        self.balances = start_balances or {config.BRIDGE.symbol: 100}
+        self.current_coin = starting_coin or config.SUPPORTED_COIN_LIST[0]
+        # (datetime, from coin, to coin) of every jump made
+        self.jumps: List[Tuple[datetime, str, str]] = []
+        self.exchange_info = ExchangeInfo(OfflineClient())
+        # symbol -> price at every step, and the one after the last
+        self.series: Dict[str, np.ndarray] = {}
+
+        self.engine = RatioEngine(self, config)
+        self.engine.set_coins(config.SUPPORTED_COIN_LIST)
+        # Stored ratio of every pair, indexed like the ratio engine
+        self.ratios = np.full((len(self.engine.symbols), len(self.engine.symbols)), np.nan)
+
+    @property
+    def datetime(self) -> datetime:
+        return self.start_date + timedelta(minutes=self.step * self.interval)
+
+    def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):  # pylint: disable=unused-argument
+        return BACKTEST_FEE
+
+    def get_series(self, symbol: str) -> np.ndarray:
+        if symbol not in self.series:
+            start = minute_of(self.start_date)
+            prices = self.store.get_prices(symbol, start, start + (self.steps + 1) * self.interval)
+            self.series[symbol] = prices[:: self.interval]
+        return self.series[symbol]
+
+    def get_market_ticker_price(self, ticker_symbol: str) -> Optional[float]:
+        price = self.get_series(ticker_symbol)[self.step]
+        return None if np.isnan(price) else float(price)
+
+    def get_alt_tick(self, origin_symbol: str, target_symbol: str):
+        return get_tick(self.exchange_info.get_filter(origin_symbol + target_symbol, "LOT_SIZE")["stepSize"])
+
+    def buy_alt(self, origin_symbol: str, target_symbol: str) -> Optional[float]:
+        target_balance = self.balances.get(target_symbol, 0)
+        from_coin_price = self.get_market_ticker_price(origin_symbol + target_symbol)
+        if from_coin_price is None:
+            # The mock manager errors out of the scout before trading
+            return None
+
+        origin_tick = self.get_alt_tick(origin_symbol, target_symbol)
+        order_quantity = math.floor(target_balance * 10 ** origin_tick / from_coin_price) / float(10 ** origin_tick)
+        target_quantity = order_quantity * from_coin_price
+        self.balances[target_symbol] -= target_quantity
+        self.balances[origin_symbol] = self.balances.get(origin_symbol, 0) + order_quantity * (1 - BACKTEST_FEE)
+        return from_coin_price
+
+    def sell_alt(self, origin_symbol: str, target_symbol: str) -> Optional[float]:
+        origin_balance = self.balances.get(origin_symbol, 0)
+        from_coin_price = self.get_market_ticker_price(origin_symbol + target_symbol)
+        if from_coin_price is None:
+            return None
+
+        origin_tick = self.get_alt_tick(origin_symbol, target_symbol)
+        order_quantity = math.floor(origin_balance * 10 ** origin_tick) / float(10 ** origin_tick)
+        target_quantity = order_quantity * from_coin_price
+        self.balances[target_symbol] = self.balances.get(target_symbol, 0) + target_quantity * (1 - BACKTEST_FEE)
+        self.balances[origin_symbol] -= order_quantity
+        return from_coin_price
+
+    def collate_coins(self, target_symbol: str):
+        total = 0
+        for coin, balance in self.balances.items():
+            if coin == self.config.BRIDGE.symbol:
+                if coin == target_symbol:
+                    total += balance
+                else:
+                    price = self.get_market_ticker_price(target_symbol + coin)
+                    if price is None:
+                        continue
+                    total += balance / price
+            else:
+                price = self.get_market_ticker_price(coin + target_symbol)
+                if price is None:
+                    continue
+                total += price * balance
+        return total
+
+    def _get_bridge_price(self, symbol: str) -> Optional[float]:
+        if symbol == self.config.BRIDGE_SYMBOL:
+            return 1
+        return self.get_market_ticker_price(symbol + self.config.BRIDGE_SYMBOL)
+
+    def initialize_trade_thresholds(self):
+        for from_symbol in self.config.SUPPORTED_COIN_LIST:
+            for to_symbol in self.config.SUPPORTED_COIN_LIST:
+                from_coin_price = self._get_bridge_price(from_symbol)
+                to_coin_price = self._get_bridge_price(to_symbol)
+                if from_symbol == to_symbol or from_coin_price is None or to_coin_price is None:
+                    continue
+                self.ratios[self.engine.index[from_symbol], self.engine.index[to_symbol]] = (
+                    from_coin_price / to_coin_price
+                )
+
+    def update_trade_threshold(self, symbol: str, coin_price: Optional[float]):
+        if coin_price is None:
+            return
+        column = self.engine.index[symbol]
+        for from_symbol in self.config.SUPPORTED_COIN_LIST:
+            from_coin_price = self._get_bridge_price(from_symbol)
+            if from_symbol == symbol or from_coin_price is None:
+                continue
+            self.ratios[self.engine.index[from_symbol], column] = from_coin_price / coin_price
+
+    def _scout(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the margin of every pair from the current coin, and the current coin price, at every step in [start, end)
+        """
+        engine = self.engine
+        bridge_symbol = self.config.BRIDGE_SYMBOL
+        coin_prices = self.get_series(self.current_coin + bridge_symbol)[start:end]
+        direct = np.column_stack([self.get_series(self.current_coin + symbol)[start:end] for symbol in engine.symbols])
+        inverse = np.column_stack([self.get_series(symbol + self.current_coin)[start:end] for symbol in engine.symbols])
+        bridge_prices = np.column_stack(
+            [self.get_series(symbol + bridge_symbol)[start:end] for symbol in engine.symbols]
+        )
+        balances = {symbol: balance for symbol, balance in self.balances.items() if balance > 0}
+        held = engine.get_held(balances, bridge_prices)
+        row = engine.index[self.current_coin]
+        margins = engine.scout_series(row, direct, inverse, coin_prices, bridge_prices, self.ratios[row], held).margins
+        return margins, coin_prices
+
+    def _next_jump(self) -> Optional[int]:
+        """
+        Find the next step, from the current one, where a scout would jump
+        """
+        for start in range(self.step, self.steps, self.LOOKAHEAD):
+            margins, coin_prices = self._scout(start, min(start + self.LOOKAHEAD, self.steps))
+            with np.errstate(invalid="ignore"):
+                jumps = np.flatnonzero((margins > 0).any(axis=1) & ~np.isnan(coin_prices))
+            if len(jumps) > 0:
+                return start + int(jumps[0])
+        return None
+
+    def _get_best_coin(self) -> str:
+        margins = self._scout(self.step, self.step + 1)[0][0]
+        # Candidates in the order of the pairs, so ties go the same way as a scout
+        candidates = [
+            (symbol, margins[self.engine.index[symbol]])
+            for symbol in self.config.SUPPORTED_COIN_LIST
+            if symbol != self.current_coin and margins[self.engine.index[symbol]] > 0
+        ]
+        return max(candidates, key=lambda candidate: candidate[1])[0]
+
+    def transaction_through_bridge(self, from_symbol: str, to_symbol: str):
+        btc_price = self.get_market_ticker_price("BTCUSDT")
+        if btc_price is None or btc_price < self.config.STOPLOSS:
+            # Without a BTC price the trader errors out of the scout
+            return
+        if not self.balances.get(from_symbol, 0):
+            return
+
+        bridge_symbol = self.config.BRIDGE_SYMBOL
+        direct_pair_price = self.get_market_ticker_price(from_symbol + to_symbol)
+        inverse_pair_price = self.get_market_ticker_price(to_symbol + from_symbol)
+        # A missing price stops the jump where the trader errors out of the scout, keeping the trades made before it
+        if direct_pair_price and direct_pair_price > 1e-6:
+            self.sell_alt(from_symbol, to_symbol)
+            price = self.get_market_ticker_price(to_symbol + bridge_symbol)
+        elif inverse_pair_price and inverse_pair_price > 1e-06:
+            price = self.buy_alt(to_symbol, from_symbol)
+            if price is None:
+                return
+            if from_symbol != bridge_symbol:
+                from_coin_price = self.get_market_ticker_price(from_symbol + bridge_symbol)
+                if from_coin_price is None:
+                    return
+                price = price * from_coin_price
+        else:
+            if self.sell_alt(from_symbol, bridge_symbol) is None:
+                return
+            price = self.buy_alt(to_symbol, bridge_symbol)
+            if price is None:
+                return
+
+        self.jumps.append((self.datetime, from_symbol, to_symbol))
+        self.update_trade_threshold(to_symbol, price)
+
+    def run(self) -> "VectorizedBacktest":
+        if self.balances.get(self.current_coin, 0) == 0:
+            self.buy_alt(self.current_coin, self.config.BRIDGE_SYMBOL)
+        self.initialize_trade_thresholds()
+
+        while self.step < self.steps:
+            jump = self._next_jump()
+            if jump is None:
+                break
+            self.step = jump
+            self.transaction_through_bridge(self.current_coin, self._get_best_coin())
+            self.step += 1
+        self.step = self.steps
+        return self
+
+
+def vectorized_backtest(
+    start_date: datetime = None,
+    end_date: datetime = None,
+    interval=1,
+    start_balances: Dict[str, float] = None,
+    starting_coin: str = None,
+    config: Config = None,
+) -> VectorizedBacktest:
+    """
+    Backtest the default strategy over the prefetched prices, with the same results as backtest(offline=True)
+
+    :param config: Configuration object to use
+    :param start_date: Date to  backtest from
+    :param end_date: Date to backtest up to
+    :param interval: Number of virtual minutes between each scout
+    :param start_balances: A dictionary of initial coin values. Default: {BRIDGE: 100}
+    :param starting_coin: The coin to start on. Default: first coin in coin list
+
+    :return: The finished backtest, with its balances, jumps, and collate_coins
+    """
+    config = config or Config()
+    return VectorizedBacktest(config, start_date, end_date, interval, start_balances, starting_coin).run()
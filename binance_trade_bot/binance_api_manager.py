@@ -1,29 +1,65 @@
 import math
+import threading
 import time
-from typing import Dict, List
+from array import array
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
 
 from binance.client import Client
 from binance.exceptions import BinanceAPIException
 from cachetools import TTLCache, cached
 
+from .binance_stream_manager import BinanceCache, BinanceStreamManager
 from .config import Config
 from .database import Database
+from .exchange_info import ExchangeInfo
 from .logger import Logger
 from .models import Coin
+from .order_book import OrderBookManager
+from .rate_limiter import Priority, RateLimitedClient, backoff_delay
 
 
 class AllTickers:  # pylint: disable=too-few-public-methods
     def __init__(self, all_tickers: List[Dict]):
-        self.all_tickers = all_tickers
+        # Parse the snapshot once: each symbol maps to its slot in a packed array of doubles, so a lookup is a dict
+        # hit instead of a scan over every ticker
+        self.symbols: Dict[str, int] = {}
+        self.prices = array("d")
+        for ticker in all_tickers:
+            if ticker["symbol"] not in self.symbols:
+                self.symbols[ticker["symbol"]] = len(self.prices)
+                self.prices.append(float(ticker["price"]))
+
+    def get_price(self, ticker_symbol) -> Optional[float]:
+        index = self.symbols.get(ticker_symbol)
+        return self.prices[index] if index is not None else None
+
+    def get_prices(self, ticker_symbols: Iterable[str]) -> List[Optional[float]]:
+        """
+        Get the price of several symbols at once, None for the ones that aren't listed
+        """
+        return [self.get_price(ticker_symbol) for ticker_symbol in ticker_symbols]
+
+    @classmethod
+    def from_prices(cls, prices: Dict[str, float]) -> "AllTickers":
+        all_tickers = cls([])
+        all_tickers.symbols = dict(zip(prices, range(len(prices))))
+        all_tickers.prices = array("d", prices.values())
+        return all_tickers
+
 
-    def get_price(self, ticker_symbol) -> object:
-        ticker = next((t for t in self.all_tickers if t["symbol"] == ticker_symbol), None)
-        return float(ticker["price"]) if ticker else None
+def get_tick(step_size: str) -> int:
+    """
+    Number of decimals a step size allows, e.g. 2 for "0.01000000" and -1 for "10.00000000"
+    """
+    if step_size.find("1") == 0:
+        return 1 - step_size.find(".")
+    return step_size.find("1") - 1
 
 
 class BinanceAPIManager:
-    def __init__(self, config: Config, db: Database, logger: Logger):
-        self.binance_client = Client(
+    def __init__(self, config: Config, db: Database, logger: Logger, binance_client: Client = None):
+        self.binance_client = binance_client or RateLimitedClient(
             config.BINANCE_API_KEY,
             config.BINANCE_API_SECRET_KEY,
             tld=config.BINANCE_TLD,
@@ -31,12 +67,42 @@ class BinanceAPIManager:
         self.db = db
         self.logger = logger
         self.config = config
+        self.cache = BinanceCache()
+        self.stream_manager: Optional[BinanceStreamManager] = None
+        self.exchange_info = ExchangeInfo(self.binance_client, logger)
+        self.order_books: Optional[OrderBookManager] = None
 
-    @cached(cache=TTLCache(maxsize=1, ttl=43200))
+    def setup_websockets(self, stream_url: str = None):
+        """
+        Start feeding the cache from the websocket streams, seeded with a REST snapshot
+        """
+        self.cache.seed_tickers(self.binance_client.get_all_tickers())
+        self.stream_manager = BinanceStreamManager(self.cache, self.binance_client, self.logger, stream_url)
+        self.stream_manager.start()
+        if self.config.ORDER_BOOK_PRICING:
+            self.order_books = OrderBookManager(self.binance_client, self.stream_manager.socket_manager, self.logger)
+            self.order_books.start(self._get_order_book_symbols())
+
+    def _get_order_book_symbols(self) -> List[str]:
+        """
+        Markets a jump between supported coins can trade on: each coin against the bridge, and each pair between them.
+        Only those trading, as the others have no order book to keep
+        """
+        self.exchange_info.load()
+        coins = set(self.config.SUPPORTED_COIN_LIST) | {self.config.BRIDGE_SYMBOL}
+        symbols = self.exchange_info.symbols
+        return [
+            from_coin + to_coin
+            for from_coin in coins
+            for to_coin in coins
+            if from_coin + to_coin in symbols and symbols[from_coin + to_coin].get("status", "TRADING") == "TRADING"
+        ]
+
+    @cached(cache=TTLCache(maxsize=1, ttl=43200), lock=threading.Lock())
     def get_trade_fees(self) -> Dict[str, float]:
         return {ticker["symbol"]: ticker["taker"] for ticker in self.binance_client.get_trade_fee()["tradeFee"]}
 
-    @cached(cache=TTLCache(maxsize=1, ttl=60))
+    @cached(cache=TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
     def get_using_bnb_for_fees(self):
         return self.binance_client.get_bnb_burn_spot_margin()["spotBNBBurn"]
 
@@ -68,14 +134,26 @@ class BinanceAPIManager:
 
     def get_all_market_tickers(self) -> AllTickers:
         """
-        Get ticker price of all coins
+        Get ticker price of all coins, from the streamed cache when it is fresh
         """
-        return AllTickers(self.binance_client.get_all_tickers())
+        if self.stream_manager is not None:
+            ticker_values = self.cache.get_ticker_values()
+            if ticker_values is not None:
+                return AllTickers.from_prices(ticker_values)
+        all_tickers = self.binance_client.get_all_tickers()
+        if self.stream_manager is not None:
+            # The stream went quiet: the snapshot we just fetched lets it pick up from here once it recovers
+            self.cache.seed_tickers(all_tickers)
+        return AllTickers(all_tickers)
 
     def get_market_ticker_price(self, ticker_symbol: str):
         """
         Get ticker price of a specific coin
         """
+        if self.stream_manager is not None:
+            ticker_values = self.cache.get_ticker_values()
+            if ticker_values is not None:
+                return ticker_values.get(ticker_symbol)
         for ticker in self.binance_client.get_symbol_ticker():
             if ticker["symbol"] == ticker_symbol:
                 return float(ticker["price"])
@@ -85,13 +163,27 @@ class BinanceAPIManager:
         """
         Get balance of a specific coin
         """
-        for currency_balance in self.binance_client.get_account()["balances"]:
+        if self.stream_manager is not None:
+            balance = self.cache.get_balance(currency_symbol)
+            if balance is not None:
+                return balance[0]
+        for currency_balance in self.get_balances():
             if currency_balance["asset"] == currency_symbol:
                 return float(currency_balance["free"])
         return None
 
     def get_balances(self):
-        return self.binance_client.get_account()["balances"]
+        """
+        Get all balances. With the user data stream running they are served from memory, and only reloaded after
+        our own orders or a stream error
+        """
+        if self.stream_manager is None:
+            return self.binance_client.get_account()["balances"]
+        balances = self.cache.get_balances()
+        if balances is None:
+            balances = self.binance_client.get_account()["balances"]
+            self.cache.seed_balances(balances)
+        return balances
 
     def retry(self, func, *args, **kwargs):
         #time.sleep(1)
@@ -104,45 +196,92 @@ class BinanceAPIManager:
                 if attempts == 0:
                     self.logger.info(e)
                 attempts += 1
-                time.sleep(5)
+                time.sleep(backoff_delay(attempts))
         return None
 
+    @contextmanager
+    def request_priority(self, priority: Priority):
+        """
+        Send the Binance requests made inside the block with another priority
+        """
+        if not isinstance(self.binance_client, RateLimitedClient):
+            yield
+            return
+        with self.binance_client.priority(priority):
+            yield
+
+    def log_request_metrics(self):
+        if isinstance(self.binance_client, RateLimitedClient):
+            self.logger.info(f"Binance requests:\n{self.binance_client.metrics.summary()}", notification=False)
+
     def get_symbol_filter(self, origin_symbol: str, target_symbol: str, filter_type: str):
-        return next(
-            _filter
-            for _filter in self.binance_client.get_symbol_info(origin_symbol + target_symbol)["filters"]
-            if _filter["filterType"] == filter_type
-        )
+        return self.exchange_info.get_filter(origin_symbol + target_symbol, filter_type)
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_alt_tick(self, origin_symbol: str, target_symbol: str):
-        step_size = self.get_symbol_filter(origin_symbol, target_symbol, "LOT_SIZE")["stepSize"]
-        if step_size.find("1") == 0:
-            return 1 - step_size.find(".")
-        return step_size.find("1") - 1
+        return get_tick(self.get_symbol_filter(origin_symbol, target_symbol, "LOT_SIZE")["stepSize"])
+
+    def get_price_tick(self, origin_symbol: str, target_symbol: str):
+        return get_tick(self.get_symbol_filter(origin_symbol, target_symbol, "PRICE_FILTER")["tickSize"])
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_min_notional(self, origin_symbol: str, target_symbol: str):
-        return float(self.get_symbol_filter(origin_symbol, target_symbol, "MIN_NOTIONAL")["minNotional"])
+        # Binance is replacing MIN_NOTIONAL with NOTIONAL, which has the same minNotional
+        _filter = self.get_symbol_filter(origin_symbol, target_symbol, "MIN_NOTIONAL") or self.get_symbol_filter(
+            origin_symbol, target_symbol, "NOTIONAL"
+        )
+        return float(_filter["minNotional"])
+
+    def format_price(self, origin_symbol: str, target_symbol: str, price: float) -> str:
+        """
+        Format an order price, rounded to the tick size of the symbol so Binance accepts it
+        """
+        price_tick = self.get_price_tick(origin_symbol, target_symbol)
+        return "{:.{}f}".format(round(price, price_tick), max(price_tick, 0))
+
+    def get_order_update(self, symbol: str, order_id: int, previous_status: Dict = None, timeout: float = 10):
+        """
+        Get the next state of an order. With the user data stream running we are woken up as soon as it changes, and
+        the order endpoint is only polled when the stream had nothing for us within the timeout
+        """
+        if self.stream_manager is not None:
+            order_status = self.cache.wait_for_order_update(order_id, previous_status, timeout)
+            if order_status is not None and order_status != previous_status:
+                return order_status
+        elif previous_status is not None:
+            time.sleep(1)
+        order_status = self.binance_client.get_order(symbol=symbol, orderId=order_id)
+        if self.stream_manager is not None:
+            self.cache.update_order(order_status)
+        return order_status
 
     def wait_for_order(self, origin_symbol, target_symbol, order_id):
+        try:
+            return self._wait_for_order(origin_symbol, target_symbol, order_id)
+        finally:
+            self.cache.forget_order(order_id)
+
+    def _wait_for_order(self, origin_symbol, target_symbol, order_id):
         status_unknown=True
+        attempt = 0
         while status_unknown:
             try:
-                order_status = self.binance_client.get_order(symbol=origin_symbol + target_symbol, orderId=order_id)
+                order_status = self.get_order_update(origin_symbol + target_symbol, order_id)
                 status_unknown=False
             except BinanceAPIException as e:
                 self.logger.info(e)
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
             except Exception as e:  # pylint: disable=broad-except
                 self.logger.info(f"Unexpected Error: {e}")
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
 
         self.logger.info(order_status)
 
+        attempt = 0
         while order_status["status"] != "FILLED":
             try:
-                order_status = self.binance_client.get_order(symbol=origin_symbol + target_symbol, orderId=order_id)
+                order_status = self.get_order_update(origin_symbol + target_symbol, order_id, order_status)
+                attempt = 0
 
                 if self._should_cancel_order(order_status):
                     cancel_order = None
@@ -151,6 +290,7 @@ class BinanceAPIManager:
                             symbol=origin_symbol + target_symbol, orderId=order_id
                         )
                     self.logger.info("Order timeout, canceled...")
+                    self.cache.invalidate_balances()
 
                     # sell partially
                     if order_status["status"] == "PARTIALLY_FILLED" and order_status["side"] == "BUY":
@@ -169,19 +309,26 @@ class BinanceAPIManager:
                 if order_status["status"] == "CANCELED":
                     self.logger.info("Order is canceled, going back to scouting mode...")
                     return None
-
-                time.sleep(1)
             except BinanceAPIException as e:
                 self.logger.info(e)
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
             except Exception as e:  # pylint: disable=broad-except
                 self.logger.info(f"Unexpected Error: {e}")
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
 
         return order_status
 
-    def buy_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers, marketBuy: bool=False):
-        return self.retry(self._buy_alt, origin_coin, target_coin, all_tickers, marketBuy=marketBuy )
+    def buy_alt(
+        self,
+        origin_coin: Coin,
+        target_coin: Coin,
+        all_tickers: AllTickers,
+        marketBuy: bool = False,
+        amount: float = None,
+    ):
+        return self.retry(self._buy_alt, origin_coin, target_coin, all_tickers, marketBuy=marketBuy, amount=amount)
 
     def _should_cancel_order(self, order_status):
         minutes = (time.time() - order_status["time"] / 1000) / 60
@@ -210,16 +357,17 @@ class BinanceAPIManager:
     def _buy_quantity(
         self, origin_symbol: str, target_symbol: str, target_balance: float = None, from_coin_price: float = None
     ):
-        target_balance = target_balance or self.get_currency_balance(target_symbol)
+        if target_balance is None:
+            target_balance = self.get_currency_balance(target_symbol)
         from_coin_price = from_coin_price or self.get_all_market_tickers().get_price(origin_symbol + target_symbol)
 
         origin_tick = self.get_alt_tick(origin_symbol, target_symbol)
         return math.floor(target_balance * 10 ** origin_tick / from_coin_price) / float(10 ** origin_tick)
 
-    def _buy_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers, marketBuy: bool=False):
+    def _buy_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers, marketBuy: bool=False, amount: float = None):
 
         """
-        Buy altcoin
+        Buy altcoin, spending at most amount of the target coin if given
         """
         trade_log = self.db.start_trade_log(origin_coin, target_coin, False)
         origin_symbol = origin_coin.symbol
@@ -240,6 +388,8 @@ class BinanceAPIManager:
             # recycle previous canceled orders
             if target_balance * target_coin_price_bridge> self.config.MAX_AMOUNT+self.config.MIN_AMOUNT:
                 target_balance=self.config.MAX_AMOUNT / target_coin_price_bridge
+        if amount is not None:
+            target_balance = min(target_balance, amount)
         order_quantity = self._buy_quantity(origin_symbol, target_symbol, target_balance, from_coin_price)
         self.logger.info(f"BUY QTY {order_quantity}")
 
@@ -252,6 +402,7 @@ class BinanceAPIManager:
             return None
 
         order = None
+        attempt = 0
         while order is None:
             try:
                 if marketBuy:
@@ -263,25 +414,32 @@ class BinanceAPIManager:
                     order = self.binance_client.order_limit_buy(
                         symbol=origin_symbol + target_symbol,
                         quantity=order_quantity,
-                        price="{:.8f}".format(from_coin_price),
+                        price=self.format_price(origin_symbol, target_symbol, from_coin_price),
                     )
                 self.logger.info(order)
             except BinanceAPIException as e:
                 self.logger.info(e)
-                time.sleep(2)
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
             except Exception as e:  # pylint: disable=broad-except
                 self.logger.info(f"Unexpected Error: {e}")
-                time.sleep(2)
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
 
+        # The order locks funds, and fills move them: whatever we have in memory is outdated from here
+        self.cache.invalidate_balances()
         trade_log.set_ordered(origin_balance, target_balance, order_quantity)
         status_unkown=True
+        attempt = 0
         while status_unkown:
             try:
                 stat = self.wait_for_order(origin_symbol, target_symbol, order["orderId"])
                 status_unkown=False
             except Exception as e:
                 print(f"status error: {e}")
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
+        self.cache.invalidate_balances()
 
         if stat is None:
             return None
@@ -298,18 +456,19 @@ class BinanceAPIManager:
 
         return order
 
-    def sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers):
-        return self.retry(self._sell_alt, origin_coin, target_coin, all_tickers)
+    def sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers, amount: float = None):
+        return self.retry(self._sell_alt, origin_coin, target_coin, all_tickers, amount=amount)
 
     def _sell_quantity(self, origin_symbol: str, target_symbol: str, origin_balance: float = None):
-        origin_balance = origin_balance or self.get_currency_balance(origin_symbol)
+        if origin_balance is None:
+            origin_balance = self.get_currency_balance(origin_symbol)
 
         origin_tick = self.get_alt_tick(origin_symbol, target_symbol)
         return math.floor(origin_balance * 10 ** origin_tick) / float(10 ** origin_tick)
 
-    def _sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers):
+    def _sell_alt(self, origin_coin: Coin, target_coin: Coin, all_tickers: AllTickers, amount: float = None):
         """
-        Sell altcoin
+        Sell altcoin, at most amount of it if given
         """
         trade_log = self.db.start_trade_log(origin_coin, target_coin, True)
         origin_symbol = origin_coin.symbol
@@ -318,6 +477,8 @@ class BinanceAPIManager:
         origin_balance = self.get_currency_balance(origin_symbol)
         target_balance = self.get_currency_balance(target_symbol)
         from_coin_price = all_tickers.get_price(origin_symbol + target_symbol)
+        if amount is not None:
+            origin_balance = min(origin_balance, amount)
         if self.config.MAX_AMOUNT:
             from_coin_price_bridge=from_coin_price
             if target_symbol != self.config.BRIDGE_SYMBOL:
@@ -336,25 +497,30 @@ class BinanceAPIManager:
         while order is None:
             # Should sell at calculated price to avoid lost coin
             order = self.binance_client.order_limit_sell(
-                symbol=origin_symbol + target_symbol, quantity=(order_quantity), price="{:.8f}".format(from_coin_price)
+                symbol=origin_symbol + target_symbol,
+                quantity=(order_quantity),
+                price=self.format_price(origin_symbol, target_symbol, from_coin_price),
             )
 
         self.logger.info("order")
         self.logger.info(order)
+        self.cache.invalidate_balances()
 
         trade_log.set_ordered(origin_balance, target_balance, order_quantity)
 
         # Binance server can take some time to save the order
         self.logger.info("Waiting for Binance")
         status_unknown=True
-
+        attempt = 0
         while status_unknown:
             try:
                 stat = self.wait_for_order(origin_symbol, target_symbol, order["orderId"])
                 status_unknown=False
             except Exception as e:
                 print(e)
-                time.sleep(1)
+                time.sleep(backoff_delay(attempt, cap=10))
+                attempt += 1
+        self.cache.invalidate_balances()
 
 
         if stat is None:
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from binance.client import Client
+from binance.websockets import BinanceSocketManager
+
+from .logger import Logger
+
+
+class BinanceCache:
+    """
+    Market and account state kept current by the websocket streams, so readers don't need a REST round-trip
+    """
+
+    def __init__(self, max_ticker_age: float = 10, max_orders: int = 1000):
+        self.max_ticker_age = max_ticker_age
+        self.max_orders = max_orders
+        self.ticker_values: Dict[str, float] = {}
+        self.ticker_updated: Optional[float] = None
+        self.ticker_lock = threading.Lock()
+        # asset -> (free, locked), None until loaded from the account endpoint
+        self.balances: Optional[Dict[str, Tuple[float, float]]] = None
+        self.balances_lock = threading.Lock()
+        # orderId -> latest known state of the order, in the shape the order endpoint returns it. Updates can come in
+        # before we know the id of an order to wait on it, so every order is kept, but only the max_orders most recently
+        # updated: orders placed by hand or by other clients are never forgotten otherwise
+        self.orders: "OrderedDict[int, Dict]" = OrderedDict()
+        self.orders_condition = threading.Condition()
+
+    def seed_tickers(self, all_tickers: List[Dict]):
+        """
+        Replace the cached prices with a full REST snapshot
+        """
+        with self.ticker_lock:
+            self.ticker_values = {ticker["symbol"]: float(ticker["price"]) for ticker in all_tickers}
+            self.ticker_updated = time.monotonic()
+
+    def update_tickers(self, prices: Dict[str, float]):
+        """
+        Merge a partial update in. Streams only send the symbols that changed, so this needs a seeded cache
+        """
+        with self.ticker_lock:
+            if self.ticker_updated is None:
+                return
+            self.ticker_values.update(prices)
+            self.ticker_updated = time.monotonic()
+
+    def get_ticker_values(self) -> Optional[Dict[str, float]]:
+        """
+        Get a copy of the cached prices, or None if the cache was never seeded or the stream went quiet
+        """
+        with self.ticker_lock:
+            if self.ticker_updated is None or time.monotonic() - self.ticker_updated > self.max_ticker_age:
+                return None
+            return dict(self.ticker_values)
+
+    def seed_balances(self, balances: List[Dict]):
+        with self.balances_lock:
+            self.balances = {
+                balance["asset"]: (float(balance["free"]), float(balance["locked"])) for balance in balances
+            }
+
+    def update_balances(self, balances: Dict[str, Tuple[float, float]]):
+        with self.balances_lock:
+            if self.balances is None:
+                # The next reader reloads everything anyway
+                return
+            self.balances.update(balances)
+
+    def invalidate_balances(self):
+        with self.balances_lock:
+            self.balances = None
+
+    def get_balances(self) -> Optional[List[Dict]]:
+        """
+        Get the balances in the shape the account endpoint returns them, or None if they need reloading
+        """
+        with self.balances_lock:
+            if self.balances is None:
+                return None
+            return [{"asset": asset, "free": free, "locked": locked} for asset, (free, locked) in self.balances.items()]
+
+    def get_balance(self, asset: str) -> Optional[Tuple[float, float]]:
+        """
+        Get (free, locked) for an asset, or None if the balances need reloading or the asset is unknown
+        """
+        with self.balances_lock:
+            if self.balances is None:
+                return None
+            return self.balances.get(asset)
+
+    def update_order(self, order: Dict):
+        with self.orders_condition:
+            self.orders[order["orderId"]] = order
+            self.orders.move_to_end(order["orderId"])
+            while len(self.orders) > self.max_orders:
+                self.orders.popitem(last=False)
+            self.orders_condition.notify_all()
+
+    def forget_order(self, order_id: int):
+        with self.orders_condition:
+            self.orders.pop(order_id, None)
+
+    def wait_for_order_update(self, order_id: int, previous: Optional[Dict], timeout: float) -> Optional[Dict]:
+        """
+        Block until the state of an order is something else than previous, or the timeout runs out. Returns the latest
+        known state, which is still previous (or None if we never heard of the order) on timeout
+        """
+        with self.orders_condition:
+            self.orders_condition.wait_for(lambda: self.orders.get(order_id) not in (None, previous), timeout)
+            return self.orders.get(order_id)
+
+
+class BinanceStreamManager:
+    def __init__(self, cache: BinanceCache, binance_client: Client, logger: Logger, stream_url: str = None):
+        self.cache = cache
+        self.logger = logger
+        self.socket_manager = BinanceSocketManager(binance_client)
+        self.socket_manager.daemon = True
+        if stream_url:
+            # Lets the streams be pointed at a local server
+            self.socket_manager.STREAM_URL = stream_url
+        self.ticker_conn_key = None
+        self.user_conn_key = None
+
+    def start(self):
+        self.ticker_conn_key = self.socket_manager.start_miniticker_socket(self._process_miniticker)
+        self.user_conn_key = self.socket_manager.start_user_socket(self._process_user_data)
+        self.socket_manager.start()
+
+    def close(self):
+        self.socket_manager.close()
+
+    def _process_miniticker(self, msg):
+        if isinstance(msg, dict) and msg.get("e") == "error":
+            # The socket gave up reconnecting: readers fall back to REST once the cache goes stale, and we open a
+            # fresh connection in the meantime
+            self.logger.warning(f"Ticker stream error: {msg.get('m')}, reconnecting")
+            self.socket_manager.stop_socket(self.ticker_conn_key)
+            self.ticker_conn_key = self.socket_manager.start_miniticker_socket(self._process_miniticker)
+            return
+        self.cache.update_tickers({ticker["s"]: float(ticker["c"]) for ticker in msg})
+
+    def _process_user_data(self, msg):
+        event_type = msg.get("e")
+        if event_type == "error":
+            # Updates may have been missed while disconnected, so reload the balances from REST
+            self.logger.warning(f"User data stream error: {msg.get('m')}, reconnecting")
+            self.cache.invalidate_balances()
+            self.socket_manager.stop_socket(self.user_conn_key)
+            self.user_conn_key = self.socket_manager.start_user_socket(self._process_user_data)
+        elif event_type == "outboundAccountPosition":
+            self.cache.update_balances(
+                {balance["a"]: (float(balance["f"]), float(balance["l"])) for balance in msg["B"]}
+            )
+        elif event_type == "balanceUpdate":
+            # Deposits and withdrawals only carry a delta
+            self.cache.invalidate_balances()
+        elif event_type == "executionReport":
+            self.cache.update_order(
+                {
+                    "symbol": msg["s"],
+                    "orderId": msg["i"],
+                    "side": msg["S"],
+                    "type": msg["o"],
+                    "status": msg["X"],
+                    "price": msg["p"],
+                    "origQty": msg["q"],
+                    "executedQty": msg["z"],
+                    "cummulativeQuoteQty": msg["Z"],
+                    "time": msg["O"],
+                    "updateTime": msg["E"],
+                }
+            )
@@ -25,7 +25,11 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
             "min_amount": 20,
             "min_bnb": 100,
             "only_direct_pairs":0,
-            "stoploss":-1
+            "stoploss":-1,
+            "runtime": "scheduler",
+            "order_book_pricing": 0,
+            "route_hubs": "",
+            "route_max_hops": 3,
         }
 
         if not os.path.exists(CFG_FL_NAME):
@@ -82,4 +86,17 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.STOPLOSS = float(
             os.environ.get("STOPLOSS") or config.get(USER_CFG_SECTION, "stoploss"))
 
+        # "scheduler" runs every job in turn on one thread, "asyncio" runs them as independent tasks
+        self.RUNTIME = os.environ.get("RUNTIME") or config.get(USER_CFG_SECTION, "runtime")
+
+        # Price jumps at what the order books would fill them at, rather than at the last trade price
+        self.ORDER_BOOK_PRICING = int(
+            os.environ.get("ORDER_BOOK_PRICING") or config.get(USER_CFG_SECTION, "order_book_pricing")
+        )
+
+        # Coins a jump may also go through on top of the bridge, e.g. "BTC BNB ETH". None keeps to the direct pair,
+        # inverse pair or bridge
+        self.ROUTE_HUBS = (os.environ.get("ROUTE_HUBS") or config.get(USER_CFG_SECTION, "route_hubs")).split()
+        self.ROUTE_MAX_HOPS = int(os.environ.get("ROUTE_MAX_HOPS") or config.get(USER_CFG_SECTION, "route_max_hops"))
+
 
@@ -1,6 +1,8 @@
 #!python3
+import asyncio
 import time
 
+from .async_runtime import AsyncRuntime
 from .binance_api_manager import BinanceAPIManager
 from .config import Config
 from .database import Database
@@ -29,14 +31,28 @@ def main():
     db.set_coins(config.SUPPORTED_COIN_LIST)
     db.migrate_old_state()
 
-    trader.initialize()
+    logger.info("Starting price streams")
+    manager.setup_websockets()
+    manager.exchange_info.start()
 
-    schedule = SafeScheduler(logger)
-    schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(trader.scout).tag("scouting")
-    schedule.every(1).minutes.do(trader.update_values).tag("updating value history")
-    schedule.every(1).minutes.do(db.prune_scout_history).tag("pruning scout history")
-    schedule.every(1).hours.do(db.prune_value_history).tag("pruning value history")
+    trader.initialize()
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    try:
+        if config.RUNTIME == "asyncio":
+            logger.info("Running jobs as asyncio tasks")
+            asyncio.run(AsyncRuntime(trader, manager, db, logger, config).run())
+            return
+
+        schedule = SafeScheduler(logger)
+        schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(trader.scout).tag("scouting")
+        schedule.every(1).minutes.do(trader.update_values).tag("updating value history")
+        schedule.every(1).minutes.do(db.prune_scout_history).tag("pruning scout history")
+        schedule.every(1).hours.do(db.prune_value_history).tag("pruning value history")
+        schedule.every(1).minutes.do(db.flush_ratios).tag("saving pair ratios")
+        schedule.every(1).hours.do(manager.log_request_metrics).tag("logging request metrics")
+
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
+    finally:
+        db.close()
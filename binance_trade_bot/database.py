@@ -1,18 +1,20 @@
 import json
 import os
-import time
+import threading
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Optional, Union
+from traceback import format_exc
+from typing import Dict, List, Optional, Union
 
-from socketio import Client
-from socketio.exceptions import ConnectionError as SocketIOConnectionError
-from sqlalchemy import create_engine, func
+from sqlalchemy import case, create_engine, func, inspect, select
 from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
 from .config import Config
 from .logger import Logger
 from .models import *  # pylint: disable=wildcard-import
+from .rate_limiter import backoff_delay
+from .update_publisher import UpdatePublisher
 
 
 class Database:
@@ -21,19 +23,21 @@ class Database:
         self.config = config
         self.engine = create_engine(uri)
         self.SessionMaker = sessionmaker(bind=self.engine)
-        self.socketio_client = Client()
+        self.update_publisher = UpdatePublisher(logger)
 
-    def socketio_connect(self):
-        if self.socketio_client.connected and self.socketio_client.namespaces:
-            return True
-        try:
-            if not self.socketio_client.connected:
-                self.socketio_client.connect("http://api:5123", namespaces=["/backend"])
-            while not self.socketio_client.connected or not self.socketio_client.namespaces:
-                time.sleep(0.1)
-            return True
-        except SocketIOConnectionError:
-            return False
+        # In-memory copy of the pairs table, loaded on first use. Reads are served from it, and ratio changes are
+        # written back in batches by flush_ratios
+        self.pairs_lock = threading.RLock()
+        self.pairs: Optional[Dict[int, Pair]] = None
+        self.pairs_from: Dict[str, List[Pair]] = {}
+        self.dirty_ratios: Dict[int, float] = {}
+        # Highest coin_value id that prune_value_history already tagged
+        self.value_pruned_id = 0
+
+        # Supported coin list the coins and pairs tables were last reconciled with
+        self.coin_symbols: Optional[List[str]] = None
+
+        self.scout_writer = ScoutHistoryWriter(self)
 
     @contextmanager
     def db_session(self):
@@ -41,40 +45,105 @@ class Database:
         Creates a context with an open SQLAlchemy session.
         """
         session: Session = scoped_session(self.SessionMaker)
-        yield session
-        session.commit()
-        session.close()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            # Leave the thread's session usable for the next try
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def load_pairs(self) -> Dict[int, Pair]:
+        """
+        Get the in-memory pair store, loading it from the database if needed
+        """
+        with self.pairs_lock:
+            if self.pairs is None:
+                session: Session
+                with self.db_session() as session:
+                    pairs: List[Pair] = session.query(Pair).all()
+                    session.expunge_all()
+                self.pairs = {pair.id: pair for pair in pairs}
+                self.pairs_from = {}
+                for pair in pairs:
+                    self.pairs_from.setdefault(pair.from_coin_id, []).append(pair)
+            return self.pairs
+
+    def reload_pairs(self):
+        """
+        Drop the pair store after the pairs table was changed behind its back. It reloads on next use
+        """
+        with self.pairs_lock:
+            self.flush_ratios()
+            self.pairs = None
+
+    def set_pair_ratio(self, pair: Pair, ratio: float):
+        """
+        Update the ratio of a pair in memory. It reaches the database on the next flush_ratios
+        """
+        with self.pairs_lock:
+            stored_pair = self.load_pairs().get(pair.id, pair)
+            stored_pair.ratio = ratio
+            pair.ratio = ratio
+            self.dirty_ratios[pair.id] = ratio
+
+    def flush_ratios(self):
+        """
+        Write every pending ratio update to the database in a single transaction
+        """
+        with self.pairs_lock:
+            if not self.dirty_ratios:
+                return
+            dirty_ratios = self.dirty_ratios
+            self.dirty_ratios = {}
+            session: Session
+            with self.db_session() as session:
+                session.bulk_update_mappings(
+                    Pair, [{"id": pair_id, "ratio": ratio} for pair_id, ratio in dirty_ratios.items()]
+                )
 
     def set_coins(self, symbols: List[str]):
+        if self.coin_symbols == list(symbols):
+            # Nothing changed since the last call
+            return
         session: Session
 
         # Add coins to the database and set them as enabled or not
         with self.db_session() as session:
             # For all the coins in the database, if the symbol no longer appears
             # in the config file, set the coin as disabled
-            coins: List[Coin] = session.query(Coin).all()
-            for coin in coins:
+            coins: Dict[str, Coin] = {coin.symbol: coin for coin in session.query(Coin).all()}
+            for coin in coins.values():
                 if coin.symbol not in symbols:
                     coin.enabled = False
 
             # For all the symbols in the config file, add them to the database
             # if they don't exist
             for symbol in symbols:
-                coin = next((coin for coin in coins if coin.symbol == symbol), None)
+                coin = coins.get(symbol)
                 if coin is None:
                     session.add(Coin(symbol))
                 else:
                     coin.enabled = True
 
-        # For all the combinations of coins in the database, add a pair to the database
+        # For all the combinations of coins in the database, add a pair to the database. Existing pairs are loaded
+        # in one query and the missing ones inserted in one go
         with self.db_session() as session:
-            coins: List[Coin] = session.query(Coin).filter(Coin.enabled).all()
-            for from_coin in coins:
-                for to_coin in coins:
-                    if from_coin != to_coin:
-                        pair = session.query(Pair).filter(Pair.from_coin == from_coin, Pair.to_coin == to_coin).first()
-                        if pair is None:
-                            session.add(Pair(from_coin, to_coin))
+            enabled_symbols = [symbol for (symbol,) in session.query(Coin.symbol).filter(Coin.enabled)]
+            existing_pairs = set(session.query(Pair.from_coin_id, Pair.to_coin_id))
+            missing_pairs = [
+                {"from_coin_id": from_symbol, "to_coin_id": to_symbol}
+                for from_symbol in enabled_symbols
+                for to_symbol in enabled_symbols
+                if from_symbol != to_symbol and (from_symbol, to_symbol) not in existing_pairs
+            ]
+            if missing_pairs:
+                session.execute(Pair.__table__.insert(), missing_pairs)
+
+        self.reload_pairs()
+        self.coin_symbols = list(symbols)
 
     def get_coins(self, only_enabled=True) -> List[Coin]:
         session: Session
@@ -116,34 +185,30 @@ class Database:
             return coin
 
     def get_pair(self, from_coin: Union[Coin, str], to_coin: Union[Coin, str]):
-        from_coin = self.get_coin(from_coin)
-        to_coin = self.get_coin(to_coin)
-        session: Session
-        with self.db_session() as session:
-            pair: Pair = session.query(Pair).filter(Pair.from_coin == from_coin, Pair.to_coin == to_coin).first()
-            session.expunge(pair)
-            return pair
+        from_symbol = from_coin.symbol if isinstance(from_coin, Coin) else from_coin
+        to_symbol = to_coin.symbol if isinstance(to_coin, Coin) else to_coin
+        with self.pairs_lock:
+            self.load_pairs()
+            return next((pair for pair in self.pairs_from.get(from_symbol, []) if pair.to_coin_id == to_symbol), None)
 
     def get_pairs_from(self, from_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
-        from_coin = self.get_coin(from_coin)
-        session: Session
-        with self.db_session() as session:
-            pairs = session.query(Pair).filter(Pair.from_coin == from_coin)
-            if only_enabled:
-                pairs = pairs.filter(Pair.enabled.is_(True))
-            pairs = pairs.all()
-            session.expunge_all()
-            return pairs
+        from_symbol = from_coin.symbol if isinstance(from_coin, Coin) else from_coin
+        with self.pairs_lock:
+            self.load_pairs()
+            return [pair for pair in self.pairs_from.get(from_symbol, []) if pair.enabled or not only_enabled]
+
+    def get_pairs_to(self, to_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
+        to_symbol = to_coin.symbol if isinstance(to_coin, Coin) else to_coin
+        with self.pairs_lock:
+            return [
+                pair
+                for pair in self.load_pairs().values()
+                if pair.to_coin_id == to_symbol and (pair.enabled or not only_enabled)
+            ]
 
     def get_pairs(self, only_enabled=True) -> List[Pair]:
-        session: Session
-        with self.db_session() as session:
-            pairs = session.query(Pair)
-            if only_enabled:
-                pairs = pairs.filter(Pair.enabled.is_(True))
-            pairs = pairs.all()
-            session.expunge_all()
-            return pairs
+        with self.pairs_lock:
+            return [pair for pair in self.load_pairs().values() if pair.enabled or not only_enabled]
 
     def log_scout(
         self,
@@ -152,15 +217,13 @@ class Database:
         current_coin_price: float,
         other_coin_price: float,
     ):
-        session: Session
-        with self.db_session() as session:
-            pair = session.merge(pair)
-            sh = ScoutHistory(pair, target_ratio, current_coin_price, other_coin_price)
-            session.add(sh)
-            #self.send_update(sh)
+        scout = ScoutHistory(pair, target_ratio, current_coin_price, other_coin_price)
+        self.scout_writer.add(scout)
+        self.send_update(scout)
 
     def prune_scout_history(self):
-        time_diff = datetime.now() - timedelta(hours=self.config.SCOUT_HISTORY_PRUNE_TIME)
+        # Scouts are saved in UTC
+        time_diff = datetime.utcnow() - timedelta(hours=self.config.SCOUT_HISTORY_PRUNE_TIME)
         session: Session
         with self.db_session() as session:
             session.query(ScoutHistory).filter(ScoutHistory.datetime < time_diff).delete()
@@ -168,64 +231,141 @@ class Database:
     def prune_value_history(self):
         session: Session
         with self.db_session() as session:
-            # Sets the first entry for each coin for each hour as 'hourly'
-            hourly_entries: List[CoinValue] = (
-                session.query(CoinValue).group_by(CoinValue.coin_id, func.strftime("%H", CoinValue.datetime)).all()
+            last_id = session.query(func.max(CoinValue.id)).scalar()
+            first_new_datetime = (
+                session.query(func.min(CoinValue.datetime)).filter(CoinValue.id > self.value_pruned_id).scalar()
             )
-            for entry in hourly_entries:
-                entry.interval = Interval.HOURLY
+            if first_new_datetime is not None:
+                # Only the weeks that received new entries need tagging again. Weeks start on a Monday, and so do
+                # the hours and days inside them
+                since = datetime.combine(first_new_datetime.date(), datetime.min.time()) - timedelta(
+                    days=first_new_datetime.weekday()
+                )
+                for interval, period_format, lower_intervals in (
+                    # Sets the first entry for each coin for each hour as 'hourly'
+                    (Interval.HOURLY, "%Y-%m-%d %H", [Interval.MINUTELY]),
+                    # Sets the first entry for each coin for each day as 'daily'
+                    (Interval.DAILY, "%Y-%m-%d", [Interval.MINUTELY, Interval.HOURLY]),
+                    # Sets the first entry for each coin for each week as 'weekly'
+                    (Interval.WEEKLY, "%Y-%W", [Interval.MINUTELY, Interval.HOURLY, Interval.DAILY]),
+                ):
+                    # Totals are tagged like the coin values they add up, so both keep the same points in time
+                    for model, group_by in ((CoinValue, [CoinValue.coin_id]), (TotalValue, [])):
+                        first_entries = (
+                            select([func.min(model.id)])
+                            .where(model.datetime >= since)
+                            .group_by(*group_by, func.strftime(period_format, model.datetime))
+                        )
+                        session.query(model).filter(
+                            model.id.in_(first_entries), model.interval.in_(lower_intervals)
+                        ).update({model.interval: interval}, synchronize_session=False)
+            self.value_pruned_id = last_id or 0
+
+            for interval, time_diff in (
+                # The last 24 hours worth of minutely entries will be kept, so
+                # count(coins) * 1440 entries
+                (Interval.MINUTELY, datetime.now() - timedelta(hours=24)),
+                # The last 28 days worth of hourly entries will be kept, so count(coins) * 672 entries
+                (Interval.HOURLY, datetime.now() - timedelta(days=28)),
+                # The last years worth of daily entries will be kept, so count(coins) * 365 entries
+                (Interval.DAILY, datetime.now() - timedelta(days=365)),
+            ):
+                for model in (CoinValue, TotalValue):
+                    session.query(model).filter(model.interval == interval, model.datetime < time_diff).delete()
 
-            # Sets the first entry for each coin for each day as 'daily'
-            daily_entries: List[CoinValue] = (
-                session.query(CoinValue).group_by(CoinValue.coin_id, func.date(CoinValue.datetime)).all()
-            )
-            for entry in daily_entries:
-                entry.interval = Interval.DAILY
+            # All weekly entries will be kept forever
 
-            # Sets the first entry for each coin for each month as 'weekly'
-            # (Sunday is the start of the week)
-            weekly_entries: List[CoinValue] = (
-                session.query(CoinValue).group_by(CoinValue.coin_id, func.strftime("%Y-%W", CoinValue.datetime)).all()
-            )
-            for entry in weekly_entries:
-                entry.interval = Interval.WEEKLY
-
-            # The last 24 hours worth of minutely entries will be kept, so
-            # count(coins) * 1440 entries
-            time_diff = datetime.now() - timedelta(hours=24)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.MINUTELY, CoinValue.datetime < time_diff
-            ).delete()
-
-            # The last 28 days worth of hourly entries will be kept, so count(coins) * 672 entries
-            time_diff = datetime.now() - timedelta(days=28)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.HOURLY, CoinValue.datetime < time_diff
-            ).delete()
-
-            # The last years worth of daily entries will be kept, so count(coins) * 365 entries
-            time_diff = datetime.now() - timedelta(days=365)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.DAILY, CoinValue.datetime < time_diff
-            ).delete()
+    def save_values(self, coin_values: List[CoinValue]):
+        """
+        Save coin values, and add them to the total value of their point in time
+        """
+        totals: Dict[datetime, List[Optional[float]]] = {}
+        for cv in coin_values:
+            total = totals.setdefault(cv.datetime, [None, None])
+            # Values without a price are left out of the sums, like SQL's SUM does
+            for i, value in enumerate((cv.btc_value, cv.usd_value)):
+                if value is not None:
+                    total[i] = (total[i] or 0) + value
 
-            # All weekly entries will be kept forever
+        session: Session
+        with self.db_session() as session:
+            for cv in coin_values:
+                session.add(cv)
+                self.send_update(cv)
+            existing = session.query(TotalValue).filter(TotalValue.datetime.in_(list(totals)))
+            for tv in existing:
+                btc_value, usd_value = totals.pop(tv.datetime)
+                if btc_value is not None:
+                    tv.btc_value = (tv.btc_value or 0) + btc_value
+                if usd_value is not None:
+                    tv.usd_value = (tv.usd_value or 0) + usd_value
+                self.send_update(tv)
+            for value_datetime, (btc_value, usd_value) in totals.items():
+                tv = TotalValue(value_datetime, btc_value, usd_value)
+                session.add(tv)
+                self.send_update(tv)
+
+    def backfill_total_values(self):
+        """
+        Fill the total value history from the coin value history, when it was saved before totals were kept
+        """
+        session: Session
+        with self.db_session() as session:
+            if session.query(TotalValue.id).first() is not None or session.query(CoinValue.id).first() is None:
+                return
+            self.logger.info("Backfilling the total value history")
+            # A point in time is kept as long as any of its coin values is
+            intervals = [Interval.MINUTELY, Interval.HOURLY, Interval.DAILY, Interval.WEEKLY]
+            interval_rank = case([(CoinValue.interval == interval, i) for i, interval in enumerate(intervals)], else_=0)
+            totals = session.query(
+                CoinValue.datetime,
+                func.sum(CoinValue.btc_value),
+                func.sum(CoinValue.usd_value),
+                func.max(interval_rank),
+            ).group_by(CoinValue.datetime)
+            session.bulk_insert_mappings(
+                TotalValue,
+                [
+                    {"datetime": tv[0], "btc_value": tv[1], "usd_value": tv[2], "interval": intervals[tv[3]]}
+                    for tv in totals
+                ],
+            )
 
     def create_database(self):
         Base.metadata.create_all(self.engine)
+        self.create_missing_indexes()
+        self.backfill_total_values()
+
+    def create_missing_indexes(self):
+        """
+        create_all only creates the indexes of tables it creates, so add the ones declared since an older database
+        was made
+        """
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    self.logger.info(f"Creating index {index.name}")
+                    index.create(self.engine)
+
+    def close(self):
+        """
+        Write out everything that is still buffered in memory
+        """
+        self.scout_writer.close()
+        self.flush_ratios()
+        self.update_publisher.close()
 
     def start_trade_log(self, from_coin: Coin, to_coin: Coin, selling: bool):
         return TradeLog(self, from_coin, to_coin, selling)
 
     def send_update(self, model):
-        if not self.socketio_connect():
-            return
-
-        self.socketio_client.emit(
-            "update",
-            {"table": model.__tablename__, "data": model.info()},
-            namespace="/backend",
-        )
+        """
+        Queue a row to be sent to the API server. Rows that are already saved are identified by their id, so only the
+        last of their updates that are waiting is sent
+        """
+        self.update_publisher.publish(model.__tablename__, model.info(), model.id)
 
     def migrate_old_state(self):
         """
@@ -244,20 +384,115 @@ class Database:
             with open(".current_coin_table") as f:
                 self.logger.info(f".current_coin_table file found, loading into database")
                 table: dict = json.load(f)
-                session: Session
-                with self.db_session() as session:
-                    for from_coin, to_coin_dict in table.items():
-                        for to_coin, ratio in to_coin_dict.items():
-                            if from_coin == to_coin:
-                                continue
-                            pair = session.merge(self.get_pair(from_coin, to_coin))
-                            pair.ratio = ratio
-                            session.add(pair)
+                for from_coin, to_coin_dict in table.items():
+                    for to_coin, ratio in to_coin_dict.items():
+                        if from_coin == to_coin:
+                            continue
+                        pair = self.get_pair(from_coin, to_coin)
+                        if pair is not None:
+                            self.set_pair_ratio(pair, ratio)
+                self.flush_ratios()
 
             os.rename(".current_coin_table", ".current_coin_table.old")
             self.logger.info(".current_coin_table renamed to .current_coin_table.old - " "You can now delete this file")
 
 
+class ScoutHistoryWriter:
+    """
+    Collects scout records in a bounded ring buffer, and writes them with a single multi-row insert from a
+    background thread, once enough of them are waiting or the oldest has waited long enough. A batch that fails to
+    write, e.g. while the database is locked, goes back to the front of the buffer and is retried with backoff
+    """
+
+    def __init__(self, db: Database, batch_size=1000, flush_interval=10, max_buffered=100000):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # If the writer falls that far behind, the oldest records are dropped rather than growing without bound
+        self.buffer = deque(maxlen=max_buffered)
+        # Records dropped that way since it was last logged
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+
+    def add(self, scout: ScoutHistory):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(
+                {
+                    "pair_id": scout.pair.id,
+                    "target_ratio": scout.target_ratio,
+                    "current_coin_price": scout.current_coin_price,
+                    "other_coin_price": scout.other_coin_price,
+                    "datetime": scout.datetime,
+                }
+            )
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.process_buffer, daemon=True)
+                self.thread.start()
+            if len(self.buffer) >= self.batch_size:
+                self.condition.notify()
+
+    def process_buffer(self):
+        attempt = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.buffer) >= self.batch_size or self.closed, self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+                attempt = 0
+            except Exception:  # pylint: disable=broad-except
+                self.db.logger.error(f"Error while saving scout history, retrying...\n{format_exc()}")
+                # Wait before retrying, unless closed in the meantime
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, backoff_delay(attempt, cap=60))
+                attempt += 1
+            self.log_dropped()
+
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                records = list(self.buffer)
+                self.buffer.clear()
+            if not records:
+                return
+            try:
+                session: Session
+                with self.db.db_session() as session:
+                    session.execute(ScoutHistory.__table__.insert(), records)
+            except Exception:
+                with self.condition:
+                    # Back in front of what was added in the meantime, keeping the newest if it doesn't all fit
+                    records.extend(self.buffer)
+                    self.dropped += max(0, len(records) - self.buffer.maxlen)
+                    self.buffer.clear()
+                    self.buffer.extend(records)
+                raise
+
+    def log_dropped(self):
+        with self.condition:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.db.logger.warning(f"Dropped {dropped} scout records that couldn't be saved in time")
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:  # pylint: disable=broad-except
+            self.db.logger.error(f"Couldn't save {len(self.buffer)} scout records\n{format_exc()}")
+        self.log_dropped()
+
+
 class TradeLog:
     def __init__(self, db: Database, from_coin: Coin, to_coin: Coin, selling: bool):
         self.db = db
@@ -269,7 +504,7 @@ class TradeLog:
             session.add(self.trade)
             # Flush so that SQLAlchemy fills in the id column
             session.flush()
-            #self.db.send_update(self.trade)
+            self.db.send_update(self.trade)
 
     def set_ordered(self, alt_starting_balance, crypto_starting_balance, alt_trade_amount):
         session: Session
@@ -279,7 +514,7 @@ class TradeLog:
             trade.alt_trade_amount = alt_trade_amount
             trade.crypto_starting_balance = crypto_starting_balance
             trade.state = TradeState.ORDERED
-            #self.db.send_update(trade)
+            self.db.send_update(trade)
 
     def set_complete(self, crypto_trade_amount):
         session: Session
@@ -287,7 +522,7 @@ class TradeLog:
             trade: Trade = session.merge(self.trade)
             trade.crypto_trade_amount = crypto_trade_amount
             trade.state = TradeState.COMPLETE
-            #self.db.send_update(trade)
+            self.db.send_update(trade)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from binance.client import Client
+
+from .logger import Logger
+
+EXCHANGE_INFO_PATH = "data/exchange_info.json"
+
+
+class ExchangeInfo:
+    """
+    The exchange info of every symbol from a single exchangeInfo request, with the filters of each symbol indexed by
+    type. Kept on disk so a restart doesn't have to download it again, and refreshed in the background
+    """
+
+    # Don't reload more often than this when asked for a symbol we don't know, e.g. one listed since the last load
+    MISSING_SYMBOL_RELOAD = 60
+
+    def __init__(self, client: Client, logger: Logger = None, path=EXCHANGE_INFO_PATH, refresh_interval=12 * 60 * 60):
+        self.client = client
+        self.logger = logger
+        self.path = path
+        self.refresh_interval = refresh_interval
+        # symbol -> its exchange info, with "filters" as filter type -> filter
+        self.symbols: Optional[Dict[str, Dict]] = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+        # Held while reloading for a missing symbol, so threads missing at the same time reload once between them
+        self.reload_lock = threading.Lock()
+        self.reload_attempted_at = 0.0
+        self.thread: Optional[threading.Thread] = None
+
+    def _index(self, exchange_info: Dict, loaded_at: float):
+        self.symbols = {
+            symbol["symbol"]: {**symbol, "filters": {_filter["filterType"]: _filter for _filter in symbol["filters"]}}
+            for symbol in exchange_info["symbols"]
+        }
+        self.loaded_at = loaded_at
+
+    def refresh(self) -> Dict:
+        """
+        Download the exchange info, save it and index it. Returns it as sent by Binance
+        """
+        exchange_info = self.client.get_exchange_info()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(exchange_info, f)
+        os.replace(tmp_path, self.path)
+        with self.lock:
+            self._index(exchange_info, time.time())
+        return exchange_info
+
+    def load(self):
+        """
+        Load the saved exchange info, or download it if there is none
+        """
+        with self.lock:
+            if self.symbols is not None:
+                return
+            try:
+                with open(self.path) as f:
+                    self._index(json.load(f), os.path.getmtime(self.path))
+                return
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        self.refresh()
+
+    def _should_reload(self) -> bool:
+        return time.time() - max(self.loaded_at, self.reload_attempted_at) > self.MISSING_SYMBOL_RELOAD
+
+    def get_symbol(self, symbol: str) -> Optional[Dict]:
+        """
+        The exchange info of a symbol, or None if it isn't listed, like Client.get_symbol_info
+        """
+        self.load()
+        info = self.symbols.get(symbol)
+        if info is None and self._should_reload():
+            with self.reload_lock:
+                # Another thread may have reloaded while we waited
+                if self._should_reload():
+                    self.reload_attempted_at = time.time()
+                    try:
+                        self.refresh()
+                    except Exception as e:  # pylint: disable=broad-except
+                        # e.g. backtesting offline, where the client can't download it
+                        if self.logger is not None:
+                            self.logger.warning(f"Couldn't reload the exchange info for {symbol}: {e}")
+            info = self.symbols.get(symbol)
+        return info
+
+    def get_filter(self, symbol: str, filter_type: str) -> Optional[Dict]:
+        info = self.get_symbol(symbol)
+        if info is None:
+            return None
+        return info["filters"].get(filter_type)
+
+    def start(self):
+        """
+        Keep the exchange info up to date from a background thread
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.load()
+                time.sleep(max(0.0, self.loaded_at + self.refresh_interval - time.time()))
+                self.refresh()
+            except Exception as e:  # pylint: disable=broad-except
+                if self.logger is not None:
+                    self.logger.warning(f"Couldn't refresh the exchange info: {e}")
+                time.sleep(60)
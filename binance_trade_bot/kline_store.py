@@ -0,0 +1,252 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import zipfile
+from calendar import timegm
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+CACHE_KEY_FORMAT = "%d %b %Y %H:%M:%S"
+
+
+def minute_of(date: datetime) -> int:
+    """
+    Minutes since the epoch of a naive UTC datetime
+    """
+    return timegm(date.utctimetuple()) // 60
+
+
+class KlineStore:
+    """
+    One price per minute per symbol, each symbol stored as a memory-mapped float64 array indexed by the minute offset
+    from its first minute. Minutes without a price are NaN. The ranges of minutes already downloaded are kept next to
+    it, so minutes Binance has no price for aren't asked for again
+    """
+
+    def __init__(self, path="data/klines", read_only=False):
+        self.path = path
+        self.read_only = read_only
+        # symbol -> (first minute, prices), None for symbols with nothing stored
+        self.arrays: Dict[str, Optional[Tuple[int, np.ndarray]]] = {}
+
+    def _data_path(self, symbol: str):
+        return os.path.join(self.path, f"{symbol}.f64")
+
+    def _meta_path(self, symbol: str):
+        return os.path.join(self.path, f"{symbol}.json")
+
+    def _fetched_path(self, symbol: str):
+        return os.path.join(self.path, f"{symbol}.fetched")
+
+    def _load(self, symbol: str) -> Optional[Tuple[int, np.ndarray]]:
+        if symbol not in self.arrays:
+            try:
+                with open(self._meta_path(symbol)) as f:
+                    start = json.load(f)["start"]
+                prices = np.memmap(self._data_path(symbol), dtype=np.float64, mode="r")
+            except (FileNotFoundError, ValueError):
+                # A missing or empty file, both mean we have no prices for that symbol
+                self.arrays[symbol] = None
+            else:
+                self.arrays[symbol] = (start, prices)
+        return self.arrays[symbol]
+
+    def symbols(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name[: -len(".json")] for name in os.listdir(self.path) if name.endswith(".json"))
+
+    def get_range(self, symbol: str) -> Optional[Tuple[int, int]]:
+        """
+        Get the first minute and the minute after the last one stored for a symbol
+        """
+        loaded = self._load(symbol)
+        if loaded is None:
+            return None
+        start, prices = loaded
+        return start, start + len(prices)
+
+    def get_price(self, symbol: str, minute: int) -> Optional[float]:
+        loaded = self._load(symbol)
+        if loaded is None:
+            return None
+        start, prices = loaded
+        offset = minute - start
+        if offset < 0 or offset >= len(prices):
+            return None
+        price = prices[offset]
+        if price != price:  # NaN
+            return None
+        return float(price)
+
+    def get_prices(self, symbol: str, start: int, end: int) -> np.ndarray:
+        """
+        Get the prices of a symbol for every minute in [start, end), NaN where unknown
+        """
+        result = np.full(end - start, np.nan)
+        loaded = self._load(symbol)
+        if loaded is not None:
+            first, prices = loaded
+            low, high = max(start, first), min(end, first + len(prices))
+            if low < high:
+                result[low - start : high - start] = prices[low - first : high - first]
+        return result
+
+    def set_prices(self, symbol: str, start: int, prices: np.ndarray):
+        """
+        Store the prices of a symbol for consecutive minutes from start. NaN entries don't overwrite stored prices
+        """
+        if self.read_only:
+            raise PermissionError("The kline store was opened read only")
+        prices = np.asarray(prices, dtype=np.float64)
+        if len(prices) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        end = start + len(prices)
+        stored = self.get_range(symbol)
+        self.arrays.pop(symbol, None)
+
+        if stored is None or start < stored[0]:
+            # The file has to start earlier, rewrite it whole
+            first = start if stored is None else min(start, stored[0])
+            last = end if stored is None else max(end, stored[1])
+            merged = self.get_prices(symbol, first, last)
+            self.arrays.pop(symbol, None)
+            known = ~np.isnan(prices)
+            merged[start - first : end - first][known] = prices[known]
+            tmp_path = self._data_path(symbol) + ".tmp"
+            merged.tofile(tmp_path)
+            os.replace(tmp_path, self._data_path(symbol))
+            with open(self._meta_path(symbol), "w") as f:
+                json.dump({"start": first}, f)
+            return
+
+        first, last = stored
+        if end > last:
+            # Growing at the end only needs an append
+            with open(self._data_path(symbol), "ab") as f:
+                np.full(end - last, np.nan).tofile(f)
+        stored_prices = np.memmap(self._data_path(symbol), dtype=np.float64, mode="r+")
+        known = ~np.isnan(prices)
+        stored_prices[start - first : end - first][known] = prices[known]
+        stored_prices.flush()
+        del stored_prices
+
+    def get_fetched(self, symbol: str) -> List[Tuple[int, int]]:
+        """
+        Get the sorted, non overlapping [start, end) ranges of minutes downloaded for a symbol, prices or not
+        """
+        try:
+            with open(self._fetched_path(symbol)) as f:
+                return [(start, end) for start, end in json.load(f)]
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def add_fetched(self, symbol: str, ranges: Iterable[Tuple[int, int]]):
+        """
+        Record [start, end) ranges of minutes as downloaded for a symbol, whether Binance had prices for them or not
+        """
+        if self.read_only:
+            raise PermissionError("The kline store was opened read only")
+        merged: List[List[int]] = []
+        for start, end in sorted([*self.get_fetched(symbol), *ranges]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._fetched_path(symbol) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(merged, f)
+        os.replace(tmp_path, self._fetched_path(symbol))
+
+    def set_price_dict(self, symbol: str, prices: Dict[int, float]):
+        """
+        Store scattered minute -> price values of a symbol
+        """
+        if not prices:
+            return
+        minutes = np.fromiter(prices.keys(), dtype=np.int64, count=len(prices))
+        start = int(minutes.min())
+        array = np.full(int(minutes.max()) - start + 1, np.nan)
+        array[minutes - start] = np.fromiter(prices.values(), dtype=np.float64, count=len(prices))
+        self.set_prices(symbol, start, array)
+
+
+def import_sqlitedict(store: KlineStore, cache_path: str) -> Dict[str, int]:
+    """
+    Import the "SYMBOL - dd Mon YYYY HH:MM:SS" -> price cache the backtester used to keep. Returns the number of prices
+    imported per symbol
+    """
+    from sqlitedict import SqliteDict  # pylint: disable=import-outside-toplevel
+
+    prices: Dict[str, Dict[int, float]] = {}
+    with SqliteDict(cache_path, flag="r") as cache:
+        for key, price in cache.items():
+            if price is None:
+                continue
+            symbol, date = key.split(" - ", 1)
+            prices.setdefault(symbol, {})[minute_of(datetime.strptime(date, CACHE_KEY_FORMAT))] = price
+    for symbol, symbol_prices in prices.items():
+        store.set_price_dict(symbol, symbol_prices)
+    return {symbol: len(symbol_prices) for symbol, symbol_prices in prices.items()}
+
+
+def _csv_lines(path: str) -> Iterable[str]:
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                with archive.open(name) as f:
+                    yield from io.TextIOWrapper(f)
+    else:
+        with open(path, newline="") as f:
+            yield from f
+
+
+def import_kline_csv(store: KlineStore, path: str, symbol: str = None) -> Tuple[str, int]:
+    """
+    Import a 1m kline dump as published on data.binance.vision (a .csv, or the .zip it comes in), keeping the open
+    price of each minute like the backtester does. The symbol defaults to the start of the file name
+    """
+    symbol = symbol or re.split(r"[-_.]", os.path.basename(path))[0].upper()
+    prices: Dict[int, float] = {}
+    for row in csv.reader(_csv_lines(path)):
+        if not row or not row[0].isdigit():
+            # Header line
+            continue
+        open_time = int(row[0])
+        # Recent dumps are in microseconds instead of milliseconds
+        open_time = open_time // 1000 if open_time > 10 ** 14 else open_time
+        prices[open_time // 60000] = float(row[1])
+    store.set_price_dict(symbol, prices)
+    return symbol, len(prices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import prices into the backtester's kline store")
+    parser.add_argument("--store", default="data/klines", help="Kline store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cache_parser = commands.add_parser("import-cache", help="Import the old SqliteDict backtest cache")
+    cache_parser.add_argument("cache", nargs="?", default="data/backtest_cache.db")
+    csv_parser = commands.add_parser("import-csv", help="Import Binance 1m kline dumps (.csv or .zip)")
+    csv_parser.add_argument("files", nargs="+")
+    csv_parser.add_argument("--symbol", help="Symbol of the files, instead of taking it from their name")
+    args = parser.parse_args()
+
+    store = KlineStore(args.store)
+    if args.command == "import-cache":
+        for symbol, count in sorted(import_sqlitedict(store, args.cache).items()):
+            print(f"{symbol}: {count} prices")
+    else:
+        for path in args.files:
+            symbol, count = import_kline_csv(store, path, args.symbol)
+            print(f"{path}: {count} {symbol} prices")
+
+
+if __name__ == "__main__":
+    main()
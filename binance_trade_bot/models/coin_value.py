@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime as _datetime
 
-from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
@@ -32,6 +32,11 @@ class CoinValue(Base):
 
     datetime = Column(DateTime)
 
+    __table_args__ = (
+        Index("ix_coin_value_coin_id_interval_datetime", "coin_id", "interval", "datetime"),
+        Index("ix_coin_value_datetime", "datetime"),
+    )
+
     def __init__(
         self,
         coin: Coin,
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -14,6 +14,8 @@ class CurrentCoin(Base):  # pylint: disable=too-few-public-methods
     coin = relationship("Coin")
     datetime = Column(DateTime)
 
+    __table_args__ = (Index("ix_current_coin_history_datetime", "datetime"),)
+
     def __init__(self, coin: Coin):
         self.coin = coin
         self.datetime = datetime.utcnow()
@@ -0,0 +1,39 @@
+from datetime import datetime as _datetime
+
+from sqlalchemy import Column, DateTime, Enum, Float, Index, Integer
+
+from .base import Base
+from .coin_value import Interval
+
+
+class TotalValue(Base):
+    """
+    Sum of the coin values saved at the same time, kept up to date as they are saved so reading the total value
+    history doesn't have to group every coin value
+    """
+
+    __tablename__ = "total_value"
+
+    id = Column(Integer, primary_key=True)
+
+    btc_value = Column(Float)
+    usd_value = Column(Float)
+
+    interval = Column(Enum(Interval))
+
+    datetime = Column(DateTime)
+
+    __table_args__ = (Index("ix_total_value_datetime", "datetime", unique=True),)
+
+    def __init__(self, datetime: _datetime, btc_value: float, usd_value: float, interval=Interval.MINUTELY):
+        self.datetime = datetime
+        self.btc_value = btc_value
+        self.usd_value = usd_value
+        self.interval = interval
+
+    def info(self):
+        return {
+            "btc": self.btc_value,
+            "usd": self.usd_value,
+            "datetime": self.datetime.isoformat(),
+        }
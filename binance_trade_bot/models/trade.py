@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, Enum, Float, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, Enum, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -36,6 +36,8 @@ class Trade(Base):  # pylint: disable=too-few-public-methods
 
     datetime = Column(DateTime)
 
+    __table_args__ = (Index("ix_trade_history_datetime", "datetime"),)
+
     def __init__(self, alt_coin: Coin, crypto_coin: Coin, selling: bool):
         self.alt_coin = alt_coin
         self.crypto_coin = crypto_coin
@@ -0,0 +1,227 @@
+import queue
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+from binance.client import Client
+from binance.exceptions import BinanceAPIException
+from binance.websockets import BinanceSocketManager
+
+from .logger import Logger
+from .rate_limiter import backoff_delay
+
+
+class OrderBook:
+    """
+    Bids and asks of one symbol, loaded from a REST snapshot and kept current with the diff depth stream. Each side is a
+    price -> quantity dict plus its prices in ascending order, so an update of an existing level is a dict write and
+    only new or emptied levels move the sorted list
+    """
+
+    def __init__(self):
+        # Last update included in the book, None until a snapshot is loaded
+        self.last_update_id: Optional[int] = None
+        self.bids: Dict[float, float] = {}
+        self.asks: Dict[float, float] = {}
+        self.bid_prices: List[float] = []
+        self.ask_prices: List[float] = []
+
+    def load_snapshot(self, snapshot: Dict):
+        self.bids = {float(price): float(quantity) for price, quantity in snapshot["bids"]}
+        self.asks = {float(price): float(quantity) for price, quantity in snapshot["asks"]}
+        self.bid_prices = sorted(self.bids)
+        self.ask_prices = sorted(self.asks)
+        self.last_update_id = snapshot["lastUpdateId"]
+
+    @staticmethod
+    def _update_side(levels: Dict[float, float], prices: List[float], updates: Iterable[List[str]]):
+        for price, quantity in updates:
+            price, quantity = float(price), float(quantity)
+            if quantity == 0:
+                if levels.pop(price, None) is not None:
+                    del prices[bisect_left(prices, price)]
+            else:
+                if price not in levels:
+                    insort(prices, price)
+                levels[price] = quantity
+
+    def apply_diff(self, event: Dict) -> bool:
+        """
+        Apply a diff depth event. Returns False when events were missed since the book was last updated, and it
+        has to be reloaded from a new snapshot
+        """
+        if self.last_update_id is None:
+            return False
+        if event["u"] <= self.last_update_id:
+            # Already part of the snapshot
+            return True
+        if event["U"] > self.last_update_id + 1:
+            return False
+        self._update_side(self.bids, self.bid_prices, event["b"])
+        self._update_side(self.asks, self.ask_prices, event["a"])
+        self.last_update_id = event["u"]
+        return True
+
+    def get_fill_price(self, side: str, quantity: float = None, quote_quantity: float = None) -> Optional[float]:
+        """
+        Average price of a market order filled against the book, for a quantity of the base asset or an amount of the
+        quote asset. What the book isn't deep enough for is priced at its last level. None if that side is empty
+
+        :param side: "BUY" walks the asks up, "SELL" walks the bids down
+        """
+        if side == "BUY":
+            levels, prices = self.asks, self.ask_prices
+        else:
+            levels, prices = self.bids, self.bid_prices
+        if not prices:
+            return None
+
+        remaining = quote_quantity if quantity is None else quantity
+        filled = cost = 0.0
+        price = prices[0]
+        for price in prices if side == "BUY" else reversed(prices):
+            level_quantity = levels[price]
+            if quantity is None:
+                level_quantity = min(level_quantity, remaining / price)
+                remaining -= level_quantity * price
+            else:
+                level_quantity = min(level_quantity, remaining)
+                remaining -= level_quantity
+            filled += level_quantity
+            cost += level_quantity * price
+            if remaining <= 0:
+                break
+        else:
+            if quantity is None:
+                filled += remaining / price
+                cost += remaining
+            else:
+                filled += remaining
+                cost += remaining * price
+        return cost / filled if filled else price
+
+
+class OrderBookManager:
+    """
+    Keeps the order books of a set of symbols in sync from one multiplexed diff depth stream. A book that misses an
+    update is reloaded from a fresh snapshot on a background thread, and isn't used until it is back in sync. Snapshots
+    that fail are retried with backoff, and a symbol whose snapshots keep failing is given up on, so its prices come
+    from the tickers
+    """
+
+    # Levels per side in a snapshot. Weight 5, deep enough for the amounts the bot trades
+    SNAPSHOT_LIMIT = 100
+    # Events kept for a book waiting on its snapshot. Older ones are covered by the snapshot anyway
+    PENDING_LIMIT = 1000
+    # Failed snapshots in a row after which a symbol is given up on
+    MAX_RESYNC_ATTEMPTS = 10
+
+    def __init__(self, binance_client: Client, socket_manager: BinanceSocketManager, logger: Logger):
+        self.binance_client = binance_client
+        self.socket_manager = socket_manager
+        self.logger = logger
+        self.books: Dict[str, OrderBook] = {}
+        # Events received while a book waits for its snapshot
+        self.pending: Dict[str, Deque[Dict]] = {}
+        # Failed snapshots in a row, by symbol
+        self.resync_attempts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.resync_queue: "queue.Queue[str]" = queue.Queue()
+        self.symbols: List[str] = []
+        self.conn_key = None
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self, symbols: Iterable[str]):
+        self.symbols = sorted(set(symbols))
+        with self.lock:
+            for symbol in self.symbols:
+                self.books[symbol] = OrderBook()
+                self.pending[symbol] = deque(maxlen=self.PENDING_LIMIT)
+        self._start_socket()
+        self.thread = threading.Thread(target=self._resync_loop, daemon=True)
+        self.thread.start()
+        for symbol in self.symbols:
+            self.resync_queue.put(symbol)
+
+    def _start_socket(self):
+        streams = [f"{symbol.lower()}@depth@100ms" for symbol in self.symbols]
+        self.conn_key = self.socket_manager.start_multiplex_socket(streams, self._process_depth)
+
+    def _process_depth(self, msg: Dict):
+        if msg.get("e") == "error":
+            # Updates were missed while disconnected: every book has to be reloaded once we are back
+            self.logger.warning(f"Depth stream error: {msg.get('m')}, reconnecting")
+            with self.lock:
+                for symbol in self.symbols:
+                    self._unsync(symbol)
+            self.socket_manager.stop_socket(self.conn_key)
+            self._start_socket()
+            return
+
+        event = msg["data"]
+        symbol = event["s"]
+        with self.lock:
+            if symbol not in self.books:
+                # Given up on
+                return
+            if symbol in self.pending:
+                self.pending[symbol].append(event)
+            elif not self.books[symbol].apply_diff(event):
+                self._unsync(symbol)
+                self.pending[symbol].append(event)
+
+    def _unsync(self, symbol: str):
+        if symbol in self.books and symbol not in self.pending:
+            self.pending[symbol] = deque(maxlen=self.PENDING_LIMIT)
+            self.resync_queue.put(symbol)
+
+    def _resync_loop(self):
+        while True:
+            symbol = self.resync_queue.get()
+            try:
+                snapshot = self.binance_client.get_order_book(symbol=symbol, limit=self.SNAPSHOT_LIMIT)
+            except Exception as e:  # pylint: disable=broad-except
+                self._retry_resync(symbol, e)
+                continue
+            self.resync_attempts.pop(symbol, None)
+            with self.lock:
+                book = self.books[symbol]
+                book.load_snapshot(snapshot)
+                for event in self.pending.pop(symbol, []):
+                    if not book.apply_diff(event):
+                        # The snapshot is older than the first event we have, try a newer one
+                        self._unsync(symbol)
+                        break
+
+    def _retry_resync(self, symbol: str, error: Exception):
+        attempt = self.resync_attempts.get(symbol, 0) + 1
+        # Client errors other than rate limits, e.g. for a halted or delisted symbol, won't go away by asking again
+        retryable = True
+        if isinstance(error, BinanceAPIException):
+            retryable = error.status_code in (418, 429) or error.status_code >= 500
+        if not retryable or attempt >= self.MAX_RESYNC_ATTEMPTS:
+            self.logger.warning(f"Couldn't load the {symbol} order book: {error}, pricing it from the tickers instead")
+            self.resync_attempts.pop(symbol, None)
+            with self.lock:
+                self.books.pop(symbol, None)
+                self.pending.pop(symbol, None)
+            return
+        self.logger.warning(f"Couldn't load the {symbol} order book: {error}, retrying")
+        self.resync_attempts[symbol] = attempt
+        # Put it back on the queue once the delay is over, without holding up the other symbols
+        timer = threading.Timer(backoff_delay(attempt), self.resync_queue.put, (symbol,))
+        timer.daemon = True
+        timer.start()
+
+    def get_fill_price(
+        self, symbol: str, side: str, quantity: float = None, quote_quantity: float = None
+    ) -> Optional[float]:
+        """
+        Average fill price of a market order, see OrderBook.get_fill_price. None for symbols without an order book in
+        sync
+        """
+        with self.lock:
+            if symbol not in self.books or symbol in self.pending:
+                return None
+            return self.books[symbol].get_fill_price(side, quantity, quote_quantity)
@@ -0,0 +1,251 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from binance.client import Client
+from binance.exceptions import BinanceAPIException
+
+# Request weight of each endpoint, by method and path after the API version. Anything not listed counts as 1
+ENDPOINT_WEIGHTS = {
+    ("get", "exchangeInfo"): 20,
+    ("get", "klines"): 2,
+    ("get", "ticker/price"): 2,
+    ("get", "ticker/24hr"): 2,
+    ("get", "ticker/bookTicker"): 2,
+    ("get", "account"): 20,
+    ("get", "order"): 4,
+    ("get", "openOrders"): 6,
+    ("get", "allOrders"): 20,
+    ("get", "myTrades"): 20,
+    ("post", "userDataStream"): 2,
+    ("put", "userDataStream"): 2,
+    ("delete", "userDataStream"): 2,
+}
+# Weight of the endpoints that cost more when asked about every symbol at once
+ALL_SYMBOLS_WEIGHTS = {
+    ("get", "ticker/price"): 4,
+    ("get", "ticker/24hr"): 80,
+    ("get", "ticker/bookTicker"): 4,
+    ("get", "openOrders"): 80,
+}
+# Weight of an order book snapshot, by the highest limit it applies to
+DEPTH_WEIGHTS = [(100, 5), (500, 25), (1000, 50), (5000, 250)]
+
+
+def backoff_delay(attempt: int, base: float = 1, cap: float = 60) -> float:
+    """
+    Seconds to wait before retrying after a number of failed attempts: exponential, capped, with full jitter so clients
+    that failed together don't all come back at the same time
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_request_weight(method: str, path: str, params: Optional[Dict]) -> int:
+    params = params or {}
+    if path == "depth":
+        limit = int(params.get("limit", 100))
+        return next((weight for max_limit, weight in DEPTH_WEIGHTS if limit <= max_limit), DEPTH_WEIGHTS[-1][1])
+    if "symbol" not in params and (method, path) in ALL_SYMBOLS_WEIGHTS:
+        return ALL_SYMBOLS_WEIGHTS[(method, path)]
+    return ENDPOINT_WEIGHTS.get((method, path), 1)
+
+
+class Priority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+# Share of the burst capacity that has to be left over for a request of each priority to go through, so lower priority
+# requests hold back first when we get close to the limit
+PRIORITY_RESERVES = {Priority.LOW: 0.5, Priority.NORMAL: 0.2, Priority.HIGH: 0.0}
+
+
+class RateLimiter:
+    """
+    Spaces out requests so their total weight stays under a budget per minute, and holds every thread back when
+    Binance tells us to slow down
+    """
+
+    def __init__(self, weight_per_minute: float):
+        self.weight_per_minute = weight_per_minute
+        self.rate = weight_per_minute / 60
+        # Allow a burst of 10 seconds worth of requests
+        self.capacity = self.rate * 10
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, weight: float, reserve: float = 0.0) -> float:
+        """
+        Wait until a request of some weight can go, leaving a share of the capacity untouched. Returns the seconds
+        waited
+        """
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    needed = weight + reserve * self.capacity
+                    if self.tokens >= needed:
+                        self.tokens -= weight
+                        return now - started
+                    wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+    def sync(self, used_weight: float):
+        """
+        Take in the weight Binance counted for the current minute, which includes requests made by anything else
+        sharing our IP
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, self.weight_per_minute - used_weight)
+
+
+class RequestMetrics:
+    """
+    Counts of what went through the request layer, per endpoint
+    """
+
+    FIELDS = ("requests", "weight", "retries", "rate_limited", "errors", "wait_seconds")
+
+    def __init__(self):
+        self.endpoints: Dict[str, Dict[str, float]] = {}
+        # Weight Binance counted for the current minute, as of the last response
+        self.used_weight = 0
+        self.lock = threading.Lock()
+
+    def add(self, endpoint: str, **counts: float):
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, dict.fromkeys(self.FIELDS, 0))
+            for name, count in counts.items():
+                metrics[name] += count
+
+    def summary(self) -> str:
+        with self.lock:
+            lines = [f"Used weight: {self.used_weight}"]
+            for endpoint, metrics in sorted(self.endpoints.items(), key=lambda item: -item[1]["weight"]):
+                lines.append(
+                    f"{endpoint}: {metrics['requests']} requests, weight {metrics['weight']}, "
+                    f"{metrics['retries']} retries, {metrics['rate_limited']} rate limited, {metrics['errors']} errors, "
+                    f"{metrics['wait_seconds']:.1f}s waited"
+                )
+            return "\n".join(lines)
+
+
+class RateLimitedClient(Client):
+    """
+    Binance client that sends every request through a weight based rate limiter, kept in sync with the weight Binance
+    reports. Requests retry with exponential backoff when rate limited, and when a read fails. Orders go first when we
+    get close to the limit, and anything run under priority(Priority.LOW) last
+    """
+
+    def __init__(
+        self,
+        api_key=None,
+        api_secret=None,
+        requests_params=None,
+        tld="com",
+        api_url: str = None,
+        weight_per_minute: float = 1200,
+        max_retries: int = 5,
+    ):
+        if api_url is not None:
+            # Talk to something else than Binance, e.g. a local fake server
+            self.API_URL = api_url
+        self.limiter = RateLimiter(weight_per_minute)
+        self.metrics = RequestMetrics()
+        self.max_retries = max_retries
+        # The base client keeps the last response on the instance, which threads sharing the client would overwrite
+        self.local = threading.local()
+        super().__init__(api_key, api_secret, requests_params, tld)
+
+    @property
+    def response(self):
+        return getattr(self.local, "response", None)
+
+    @response.setter
+    def response(self, response):
+        self.local.response = response
+
+    @contextmanager
+    def priority(self, priority: Priority):
+        """
+        Send the requests made by this thread inside the block with another priority
+        """
+        previous = getattr(self.local, "priority", None)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def _get_priority(self, path: str) -> Priority:
+        if path == "order":
+            return Priority.HIGH
+        priority = getattr(self.local, "priority", None)
+        return Priority.NORMAL if priority is None else priority
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        path = urlparse(uri).path.split("/", 3)[-1]
+        params = kwargs.get("data") if isinstance(kwargs.get("data"), dict) else None
+        weight = get_request_weight(method, path, params)
+        reserve = PRIORITY_RESERVES[self._get_priority(path)]
+        # Only reads are safe to send again when we don't know whether the first one went through
+        idempotent = method == "get"
+
+        attempt = 0
+        while True:
+            waited = self.limiter.acquire(weight, reserve)
+            self.metrics.add(path, requests=1, weight=weight, wait_seconds=waited)
+            # The base client signs and reorders the params in place
+            attempt_kwargs = {**kwargs, "data": dict(params)} if params is not None else dict(kwargs)
+            self.response = None
+            try:
+                return super()._request(method, uri, signed, force_params, **attempt_kwargs)
+            except BinanceAPIException as e:
+                # 429 is a warning, 418 means the IP got banned for ignoring it. Both say how long to back off for
+                rate_limited = e.status_code in (418, 429)
+                if rate_limited:
+                    self.metrics.add(path, rate_limited=1)
+                if attempt >= self.max_retries or not (rate_limited or (idempotent and e.status_code >= 500)):
+                    self.metrics.add(path, errors=1)
+                    raise
+                if rate_limited:
+                    self.limiter.pause(float(e.response.headers.get("Retry-After", 0)) or backoff_delay(attempt))
+                else:
+                    time.sleep(backoff_delay(attempt))
+            except requests.exceptions.RequestException:
+                if not idempotent or attempt >= self.max_retries:
+                    self.metrics.add(path, errors=1)
+                    raise
+                time.sleep(backoff_delay(attempt))
+            finally:
+                self._sync_weight()
+            attempt += 1
+            self.metrics.add(path, retries=1)
+
+    def _sync_weight(self):
+        response = self.response
+        if response is None:
+            return
+        used_weight = response.headers.get("X-MBX-USED-WEIGHT-1M") or response.headers.get("X-MBX-USED-WEIGHT")
+        if used_weight is not None:
+            self.metrics.used_weight = int(used_weight)
+            self.limiter.sync(int(used_weight))
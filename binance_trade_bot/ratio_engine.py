@@ -0,0 +1,269 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from .binance_api_manager import AllTickers, BinanceAPIManager
+from .config import Config
+from .models import Coin, Pair
+from .order_book import OrderBookManager
+
+
+class ScoutMargins(NamedTuple):
+    """
+    One row per scouted coin, one column per coin of the engine. Columns that aren't a candidate jump are NaN
+    in margins
+    """
+
+    margins: np.ndarray
+    coin_prices: np.ndarray
+    optional_coin_prices: np.ndarray
+
+
+class RatioEngine:
+    """
+    Computes the scout margin of many pairs in one vectorized pass, following the same route rules as a jump:
+    direct pair first, then inverse pair, then through the bridge coin
+    """
+
+    def __init__(self, manager: BinanceAPIManager, config: Config):
+        self.manager = manager
+        self.config = config
+        self.symbols: List[str] = []
+        self.index: Dict[str, int] = {}
+        self._all_tickers: Optional[AllTickers] = None
+        self._bridge_prices = np.empty(0)
+        self._direct_matrix: Optional[np.ndarray] = None
+        self._direct_prices: Dict[int, np.ndarray] = {}
+        self._inverse_prices: Dict[int, np.ndarray] = {}
+        # Markets listed between two of our coins, found by scanning every combination once per set of symbols
+        self._listed_count: Optional[int] = None
+        self._listed_names: List[str] = []
+        self._listed_rows = np.empty(0, dtype=int)
+        self._listed_columns = np.empty(0, dtype=int)
+
+    def set_coins(self, symbols: Sequence[str]):
+        """
+        Rebuild the coin index and the fee matrices, when the set of coins changed
+        """
+        symbols = sorted(set(symbols))
+        if symbols == self.symbols:
+            return
+        self.symbols = symbols
+        self.index = {symbol: i for i, symbol in enumerate(symbols)}
+        self._all_tickers = None
+        self._listed_count = None
+
+        bridge = self.config.BRIDGE
+        coins = [Coin(symbol) for symbol in symbols]
+        get_fee = self.manager.get_fee
+        # Fees don't move with prices, so they are looked up once per coin set rather than once per scout
+        self._direct_fees = np.array([[get_fee(from_coin, to_coin, True) for to_coin in coins] for from_coin in coins])
+        self._inverse_fees = np.array(
+            [[get_fee(to_coin, from_coin, False) for to_coin in coins] for from_coin in coins]
+        )
+        self._bridge_fees = np.add.outer(
+            [get_fee(coin, bridge, True) for coin in coins], [get_fee(coin, bridge, False) for coin in coins]
+        )
+        self._held_thresholds = np.array(
+            [self.config.MIN_AMOUNT + (self.config.MIN_BNB if symbol == "BNB" else 0) for symbol in symbols]
+        )
+
+    def load_prices(self, all_tickers: AllTickers):
+        if all_tickers is self._all_tickers:
+            return
+        self._all_tickers = all_tickers
+        self._direct_matrix = None
+        self._direct_prices = {}
+        self._inverse_prices = {}
+        bridge_symbol = self.config.BRIDGE_SYMBOL
+        self._bridge_prices = self._get_prices(symbol + bridge_symbol for symbol in self.symbols)
+        if getattr(all_tickers, "symbols", None) is not None:
+            self._direct_matrix = self._load_direct_matrix(all_tickers)
+
+    def _load_direct_matrix(self, all_tickers: AllTickers) -> np.ndarray:
+        """
+        Gather the price of every market between two of our coins straight out of the ticker array
+        """
+        slots = [all_tickers.symbols.get(name) for name in self._listed_names]
+        if self._listed_count != len(all_tickers.symbols) or None in slots:
+            # Listings changed since we last looked
+            listed = [
+                (row, column, from_symbol + to_symbol)
+                for row, from_symbol in enumerate(self.symbols)
+                for column, to_symbol in enumerate(self.symbols)
+                if from_symbol + to_symbol in all_tickers.symbols
+            ]
+            self._listed_count = len(all_tickers.symbols)
+            self._listed_rows = np.array([row for row, _, _ in listed], dtype=int)
+            self._listed_columns = np.array([column for _, column, _ in listed], dtype=int)
+            self._listed_names = [name for _, _, name in listed]
+            slots = [all_tickers.symbols[name] for name in self._listed_names]
+
+        direct = np.full((len(self.symbols), len(self.symbols)), np.nan)
+        direct[self._listed_rows, self._listed_columns] = np.frombuffer(all_tickers.prices, dtype=float)[
+            np.array(slots, dtype=int)
+        ]
+        return direct
+
+    def _get_prices(self, ticker_symbols) -> np.ndarray:
+        # Missing symbols come back as None, which numpy turns into NaN
+        return np.array(self._all_tickers.get_prices(ticker_symbols), dtype=float)
+
+    def _route_prices(self, row: int):
+        # Tickers that aren't backed by a price array (the backtester's) are looked up one symbol at a time, and
+        # only for the rows being scouted
+        if row not in self._direct_prices:
+            symbol = self.symbols[row]
+            self._direct_prices[row] = self._get_prices(symbol + to_symbol for to_symbol in self.symbols)
+            self._inverse_prices[row] = self._get_prices(to_symbol + symbol for to_symbol in self.symbols)
+        return self._direct_prices[row], self._inverse_prices[row]
+
+    def get_ratios(self, pairs: List[Pair]) -> np.ndarray:
+        """
+        Get the stored ratio of every pair as a matrix, NaN where there is no pair or no ratio yet
+        """
+        ratios = np.full((len(self.symbols), len(self.symbols)), np.nan)
+        for pair in pairs:
+            if pair.ratio is not None:
+                ratios[self.index[pair.from_coin_id], self.index[pair.to_coin_id]] = pair.ratio
+        return ratios
+
+    def get_held(self, balances: Dict[str, float], bridge_prices: np.ndarray = None) -> np.ndarray:
+        """
+        Flag the coins we already hold more of than the minimum amount, which aren't worth jumping to
+
+        :param bridge_prices: Price of each coin against the bridge coin, with one row per point in time to get the
+            held coins at each of them. Default: the loaded prices
+        """
+        if bridge_prices is None:
+            bridge_prices = self._bridge_prices
+        amounts = np.array([balances.get(symbol, 0) for symbol in self.symbols], dtype=float)
+        prices = np.where(np.array(self.symbols) == self.config.BRIDGE_SYMBOL, 1, bridge_prices)
+        with np.errstate(invalid="ignore"):
+            return amounts * prices > self._held_thresholds
+
+    def scout(self, rows: Sequence[int], coin_prices: np.ndarray, ratios: np.ndarray, held: np.ndarray) -> ScoutMargins:
+        """
+        Compute the scout margin from each coin in rows to every coin of the engine
+
+        :param rows: Index of the coins to scout from
+        :param coin_prices: Price of each of those coins against the bridge coin
+        :param ratios: Stored pair ratios, with one row per entry of rows
+        :param held: Coins to leave out, see get_held
+        """
+        rows = np.asarray(rows, dtype=int)
+        if self._direct_matrix is not None:
+            direct = self._direct_matrix[rows]
+            inverse = self._direct_matrix.T[rows]
+        else:
+            direct = np.array([self._route_prices(row)[0] for row in rows]).reshape(len(rows), len(self.symbols))
+            inverse = np.array([self._route_prices(row)[1] for row in rows]).reshape(len(rows), len(self.symbols))
+        return self._scout(rows, direct, inverse, np.asarray(coin_prices)[:, None], self._bridge_prices, ratios, held)
+
+    def scout_order_books(
+        self,
+        rows: Sequence[int],
+        coin_prices: np.ndarray,
+        amounts: Sequence[float],
+        order_books: OrderBookManager,
+        ratios: np.ndarray,
+        held: np.ndarray,
+    ) -> ScoutMargins:
+        """
+        Like scout, but each price is the average price the order book would fill the jump at, for the amount it would
+        trade. Prices whose order book isn't in sync stay the ticker ones
+
+        :param amounts: Quantity of each coin in rows a jump would sell
+        :param order_books: Order books of the markets between our coins
+        """
+        rows = np.asarray(rows, dtype=int)
+        bridge_symbol = self.config.BRIDGE_SYMBOL
+        if self._direct_matrix is not None:
+            direct = self._direct_matrix[rows]
+            inverse = self._direct_matrix.T[rows]
+        else:
+            direct = np.array([self._route_prices(row)[0] for row in rows]).reshape(len(rows), len(self.symbols))
+            inverse = np.array([self._route_prices(row)[1] for row in rows]).reshape(len(rows), len(self.symbols))
+        with np.errstate(invalid="ignore"):
+            use_direct = direct > 1e-06
+            use_inverse = ~use_direct & (inverse > 1e-06)
+        direct = direct.copy()
+        inverse = inverse.copy()
+        coin_prices = np.array(coin_prices, dtype=float)
+        bridge_prices = np.tile(self._bridge_prices, (len(rows), 1))
+
+        for i, row in enumerate(rows):
+            symbol = self.symbols[row]
+            amount = amounts[i]
+            if symbol != bridge_symbol:
+                fill_price = order_books.get_fill_price(symbol + bridge_symbol, "SELL", quantity=amount)
+                if fill_price is not None:
+                    coin_prices[i] = fill_price
+            bridge_amount = amount * coin_prices[i]
+            for column, to_symbol in enumerate(self.symbols):
+                if column == row:
+                    continue
+                if use_direct[i, column]:
+                    fill_price = order_books.get_fill_price(symbol + to_symbol, "SELL", quantity=amount)
+                    prices = direct
+                elif use_inverse[i, column]:
+                    fill_price = order_books.get_fill_price(to_symbol + symbol, "BUY", quote_quantity=amount)
+                    prices = inverse
+                else:
+                    fill_price = order_books.get_fill_price(
+                        to_symbol + bridge_symbol, "BUY", quote_quantity=bridge_amount
+                    )
+                    prices = bridge_prices
+                if fill_price is not None:
+                    prices[i, column] = fill_price
+        return self._scout(rows, direct, inverse, coin_prices[:, None], bridge_prices, ratios, held)
+
+    def scout_series(
+        self,
+        row: int,
+        direct: np.ndarray,
+        inverse: np.ndarray,
+        coin_prices: np.ndarray,
+        bridge_prices: np.ndarray,
+        ratios: np.ndarray,
+        held: np.ndarray,
+    ) -> ScoutMargins:
+        """
+        Compute the scout margin from one coin to every coin of the engine, at many points in time. Each argument but
+        row and ratios has one row per point in time
+
+        :param row: Index of the coin to scout from
+        :param direct: Price of the pair from the coin to each coin
+        :param inverse: Price of the pair from each coin to the coin
+        :param coin_prices: Price of the coin against the bridge coin
+        :param bridge_prices: Price of each coin against the bridge coin
+        :param ratios: Stored ratio of the pair from the coin to each coin
+        :param held: Coins to leave out, see get_held
+        """
+        return self._scout(row, direct, inverse, np.asarray(coin_prices)[:, None], bridge_prices, ratios, held)
+
+    def _scout(self, rows, direct, inverse, coin_prices, bridge_prices, ratios, held) -> ScoutMargins:
+        with np.errstate(invalid="ignore"):
+            use_direct = direct > 1e-06
+            use_inverse = ~use_direct & (inverse > 1e-06)
+        use_bridge = ~use_direct & ~use_inverse
+
+        coin_price = np.where(use_direct, direct, np.where(use_inverse, 1.0, coin_prices))
+        optional_coin_price = np.where(use_direct, 1.0, np.where(use_inverse, inverse, bridge_prices))
+        transaction_fee = np.where(
+            use_direct,
+            self._direct_fees[rows],
+            np.where(use_inverse, self._inverse_fees[rows], self._bridge_fees[rows]),
+        )
+
+        # Same operations, in the same order, as the scalar version of this formula, so results are bit for bit equal
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coin_opt_coin_ratio = coin_price / optional_coin_price
+            margins = (
+                coin_opt_coin_ratio - transaction_fee * self.config.SCOUT_MULTIPLIER * coin_opt_coin_ratio
+            ) - ratios
+            excluded = ~(optional_coin_price > 0) | held
+        if self.config.ONLY_DIRECT_PAIRS:
+            excluded |= use_bridge
+        margins[excluded] = np.nan
+        return ScoutMargins(margins, coin_price, optional_coin_price)
@@ -0,0 +1,205 @@
+from itertools import permutations
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from .binance_api_manager import AllTickers, BinanceAPIManager
+from .config import Config
+from .models import Coin
+from .ratio_engine import ScoutMargins
+
+
+class RouteHop(NamedTuple):
+    symbol: str
+    from_coin: str
+    to_coin: str
+    # True when the hop sells the base asset of the market, False when it buys it
+    selling: bool
+
+
+class Route(NamedTuple):
+    hops: List[RouteHop]
+    # Quantity of the last coin one unit of the first coin trades for, before fees
+    rate: float
+    # Fees of every hop, added up like the fees of a jump through the bridge
+    fee: float
+
+    @property
+    def coins(self) -> List[str]:
+        return [self.hops[0].from_coin] + [hop.to_coin for hop in self.hops]
+
+
+class RouteEngine:
+    """
+    Finds the best route of up to max_hops trades between every two coins, going through hub coins (and the bridge)
+    in between. Each market is an edge both ways, weighted by minus the log of what it trades one unit for net of fees,
+    so the best route is the one whose weights add up lowest. Routes only go through hubs, which keeps the search to
+    a few sequences of hubs, each evaluated for every pair of coins at once
+    """
+
+    def __init__(self, manager: BinanceAPIManager, config: Config):
+        self.manager = manager
+        self.config = config
+        self.hubs = [hub for hub in config.ROUTE_HUBS if hub != config.BRIDGE_SYMBOL] + [config.BRIDGE_SYMBOL]
+        # A single hop when only direct pairs are allowed, like the ratio engine
+        self.max_hops = 1 if config.ONLY_DIRECT_PAIRS else config.ROUTE_MAX_HOPS
+        self.symbols: List[str] = []
+        self.index: Dict[str, int] = {}
+        self._all_tickers: Optional[AllTickers] = None
+
+    def set_coins(self, symbols: Sequence[str]):
+        """
+        Rebuild the graph, when the set of coins changed. Coins come first in the nodes, then the hubs that aren't
+        one of them
+        """
+        symbols = list(symbols)
+        if symbols == self.symbols:
+            return
+        self.symbols = symbols
+        self.index = {symbol: i for i, symbol in enumerate(symbols)}
+        self._all_tickers = None
+
+        nodes = symbols + [hub for hub in self.hubs if hub not in self.index]
+        node_index = {symbol: i for i, symbol in enumerate(nodes)}
+        self._nodes = nodes
+        self._hub_nodes = [node_index[hub] for hub in self.hubs]
+
+        self.manager.exchange_info.load()
+        markets = [
+            (name, node_index[info["baseAsset"]], node_index[info["quoteAsset"]])
+            for name, info in self.manager.exchange_info.symbols.items()
+            if info.get("status", "TRADING") == "TRADING"
+            and info["baseAsset"] in node_index
+            and info["quoteAsset"] in node_index
+        ]
+        self._market_names = [name for name, _, _ in markets]
+        self._bases = np.array([base for _, base, _ in markets], dtype=int)
+        self._quotes = np.array([quote for _, _, quote in markets], dtype=int)
+        get_fee = self.manager.get_fee
+        # Fees don't move with prices, so they are looked up once per coin set rather than once per scout
+        self._sell_fees = np.array([get_fee(Coin(nodes[b]), Coin(nodes[q]), True) for _, b, q in markets], dtype=float)
+        self._buy_fees = np.array([get_fee(Coin(nodes[b]), Coin(nodes[q]), False) for _, b, q in markets], dtype=float)
+        self._market_prices = np.full(len(markets), np.nan)
+
+        # Each edge can be a sell on the market from -> to, or a buy on the market to -> from: both are kept, and the
+        # cheaper one is used. Log rates before fees, inf where there is no market
+        size = len(nodes)
+        self._sell_log_rates = np.full((size, size), -np.inf)
+        self._buy_log_rates = np.full((size, size), -np.inf)
+        self._sell_fee_matrix = np.zeros((size, size))
+        self._buy_fee_matrix = np.zeros((size, size))
+        self._sell_fee_matrix[self._bases, self._quotes] = self._sell_fees
+        self._buy_fee_matrix[self._quotes, self._bases] = self._buy_fees
+        self._sell_markets = np.full((size, size), -1)
+        self._buy_markets = np.full((size, size), -1)
+        self._sell_markets[self._bases, self._quotes] = np.arange(len(markets))
+        self._buy_markets[self._quotes, self._bases] = np.arange(len(markets))
+
+        # Every sequence of distinct hubs a route can go through, the empty one being a single trade between the coins
+        self._hub_sequences = [
+            hubs for length in range(self.max_hops) for hubs in permutations(self._hub_nodes, length)
+        ]
+
+    def load_prices(self, all_tickers: AllTickers):
+        """
+        Update the edges of the markets whose price changed since the last snapshot, then find the best route between
+        every two coins
+        """
+        if all_tickers is self._all_tickers:
+            return
+        self._all_tickers = all_tickers
+        prices = np.array(all_tickers.get_prices(self._market_names), dtype=float)
+        with np.errstate(invalid="ignore"):
+            changed = np.flatnonzero(~(prices == self._market_prices))
+        self._market_prices = prices
+
+        changed_prices = prices[changed]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_prices = np.where(changed_prices > 0, np.log(changed_prices), np.nan)
+        bases, quotes = self._bases[changed], self._quotes[changed]
+        # Selling one unit of the base gets price units of the quote, one unit of the quote buys 1 / price of the base
+        self._sell_log_rates[bases, quotes] = np.where(np.isnan(log_prices), -np.inf, log_prices)
+        self._buy_log_rates[quotes, bases] = np.where(np.isnan(log_prices), -np.inf, -log_prices)
+        self._find_routes()
+
+    def _find_routes(self):
+        with np.errstate(invalid="ignore"):
+            sell_costs = -(self._sell_log_rates + np.log1p(-self._sell_fee_matrix))
+            buy_costs = -(self._buy_log_rates + np.log1p(-self._buy_fee_matrix))
+        self._edge_sells = sell_costs <= buy_costs
+        edge_costs = np.where(self._edge_sells, sell_costs, buy_costs)
+        edge_log_rates = np.where(self._edge_sells, self._sell_log_rates, self._buy_log_rates)
+        edge_fees = np.where(self._edge_sells, self._sell_fee_matrix, self._buy_fee_matrix)
+
+        count = len(self.symbols)
+        costs = np.empty((len(self._hub_sequences), count, count))
+        log_rates = np.empty_like(costs)
+        fees = np.empty_like(costs)
+        for i, hubs in enumerate(self._hub_sequences):
+            path = (slice(0, count),) + hubs + (slice(0, count),)
+            costs[i] = self._path_sum(edge_costs, path)
+            log_rates[i] = self._path_sum(edge_log_rates, path)
+            fees[i] = self._path_sum(edge_fees, path)
+            # A coin that is also a hub can't be gone through on its way to or from itself
+            for hub in hubs:
+                if hub < count:
+                    costs[i, hub, :] = np.inf
+                    costs[i, :, hub] = np.inf
+        costs[:, np.arange(count), np.arange(count)] = np.inf
+
+        self._best = np.argmin(costs, axis=0)
+        rows, columns = np.indices((count, count))
+        self._costs = costs[self._best, rows, columns]
+        self._log_rates = log_rates[self._best, rows, columns]
+        self._fees = fees[self._best, rows, columns]
+
+    @staticmethod
+    def _path_sum(edges: np.ndarray, path) -> np.ndarray:
+        """
+        Add up the edges along a path from every coin to every coin, through a fixed sequence of hubs
+        """
+        if len(path) == 2:
+            return edges[path[0], path[1]]
+        total = edges[path[0], path[1]][:, None] + edges[path[-2], path[-1]][None, :]
+        for from_node, to_node in zip(path[1:-2], path[2:-1]):
+            total = total + edges[from_node, to_node]
+        return total
+
+    def scout(self, rows: Sequence[int], ratios: np.ndarray, held: np.ndarray) -> ScoutMargins:
+        """
+        Compute the scout margin from each coin in rows to every coin, along the best route between them. Coin prices
+        are the route rates, optional coin prices 1 where there is a route and NaN where there is none
+
+        :param rows: Index of the coins to scout from
+        :param ratios: Stored pair ratios, with one row per entry of rows
+        :param held: Coins to leave out
+        """
+        rows = np.asarray(rows, dtype=int)
+        found = np.isfinite(self._costs[rows])
+        with np.errstate(over="ignore", invalid="ignore"):
+            coin_opt_coin_ratio = np.exp(self._log_rates[rows])
+            margins = (
+                coin_opt_coin_ratio - self._fees[rows] * self.config.SCOUT_MULTIPLIER * coin_opt_coin_ratio
+            ) - ratios
+        margins[~found | held] = np.nan
+        return ScoutMargins(margins, coin_opt_coin_ratio, np.where(found, 1.0, np.nan))
+
+    def get_route(self, from_symbol: str, to_symbol: str, all_tickers: AllTickers) -> Optional[Route]:
+        """
+        Get the best route between two of the coins at the prices of a snapshot, None if there is none
+        """
+        self.load_prices(all_tickers)
+        row, column = self.index[from_symbol], self.index[to_symbol]
+        if not np.isfinite(self._costs[row, column]):
+            return None
+        path = (row,) + self._hub_sequences[self._best[row, column]] + (column,)
+        hops = []
+        for from_node, to_node in zip(path, path[1:]):
+            from_coin, to_coin = self._nodes[from_node], self._nodes[to_node]
+            if self._edge_sells[from_node, to_node]:
+                symbol = self._market_names[self._sell_markets[from_node, to_node]]
+                hops.append(RouteHop(symbol, from_coin, to_coin, True))
+            else:
+                symbol = self._market_names[self._buy_markets[from_node, to_node]]
+                hops.append(RouteHop(symbol, from_coin, to_coin, False))
+        return Route(hops, float(np.exp(self._log_rates[row, column])), float(self._fees[row, column]))
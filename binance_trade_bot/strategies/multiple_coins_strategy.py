@@ -1,29 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
+
 from binance_trade_bot.auto_trader import AutoTrader
+from binance_trade_bot.binance_api_manager import AllTickers
+from binance_trade_bot.models import Coin, Pair
 
 
 class Strategy(AutoTrader):
     def scout(self):
         """
-        Scout for potential jumps from the current coin to another coin
+        Scout for potential jumps from every held coin to another coin
         """
 
 
         have_coin = False
 
-        # last coin bought
+        # One snapshot of prices and balances for every held coin
+        all_tickers = self.manager.get_all_market_tickers()
         current_balances=self.manager.get_balances()
         current_balances_dict={d['asset']:float(d['free']) for d in current_balances if float(d['free'])>0}
 
-        list_coins=self.db.get_coins()
-        for coin in list_coins:
-            if not coin.symbol in current_balances_dict:
-                continue
-            all_tickers = self.manager.get_all_market_tickers()
+        list_coins=[coin for coin in self.db.get_coins() if coin.symbol in current_balances_dict]
+        if list_coins:
             btc_price = all_tickers.get_price('BTCUSDT')
             stoploss = self.config.STOPLOSS
             if stoploss and btc_price < stoploss:
                 self.logger.info(f"btc price too low ( {btc_price}) - skip scouting")
                 return
+
+        coin_prices: Dict[Coin, float] = {}
+        for coin in list_coins:
             current_coin_balance = current_balances_dict[coin.symbol]
             if coin.symbol==self.config.BRIDGE_SYMBOL:
                 coin_price=1
@@ -50,14 +56,52 @@ class Strategy(AutoTrader):
             # Display on the console, the current coin+Bridge, so users can see *some* activity and not think the bot
             # has stopped. Not logging though to reduce log size.
             self.logger.info(f"Scouting for best trades. Current coin: {coin} ")
-
-            result=self._jump_to_best_coin(coin, coin_price, all_tickers)
-            if result:
-                #refresh prices and balances
-                all_tickers = self.manager.get_all_market_tickers()
-                current_balances = self.manager.get_balances()
-                current_balances_dict = {d['asset']: float(d['free']) for d in current_balances if float(d['free']) > 0}
-                self.db.set_coins(self.config.SUPPORTED_COIN_LIST)
+            coin_prices[coin] = coin_price
 
         if not have_coin:
             self.bridge_scout()
+            return
+
+        pairs = [pair for coin in coin_prices for pair in self.db.get_pairs_from(coin)]
+        all_ratios = self._get_all_ratios(coin_prices, pairs, all_tickers, current_balances_dict)
+
+        # Only jumps that don't share a coin can run together: two jumps from or to the same coin would race for the
+        # same balance, and the second one would have been skipped anyway once the first made it a held coin
+        jumps: List[Pair] = []
+        busy_coins = set()
+        for coin in coin_prices:
+            best_pair = self._get_best_pair(coin, all_ratios[coin.symbol])
+            if best_pair is None:
+                continue
+            jump_coins = self._get_route_coins(best_pair, all_tickers)
+            if busy_coins & jump_coins:
+                self.logger.info(f"Postponing jump from {coin} to {best_pair.to_coin_id} to the next scout")
+                continue
+            busy_coins |= jump_coins
+            jumps.append(best_pair)
+
+        if not jumps:
+            return
+        if len(jumps) == 1:
+            self.transaction_through_bridge(jumps[0], all_tickers)
+        else:
+            # Each jump spends most of its time waiting on its orders, so they wait side by side
+            with ThreadPoolExecutor(max_workers=len(jumps), thread_name_prefix="jump") as executor:
+                futures = [executor.submit(self.transaction_through_bridge, pair, all_tickers) for pair in jumps]
+            for future in futures:
+                future.result()
+        self.db.set_coins(self.config.SUPPORTED_COIN_LIST)
+
+    def _get_route_coins(self, pair: Pair, all_tickers: AllTickers) -> Set[str]:
+        """
+        Coins whose balance a jump trades, the bridge or hubs included when it has to go through them
+        """
+        if self.route_engine is not None:
+            route = self.route_engine.get_route(pair.from_coin_id, pair.to_coin_id, all_tickers)
+            return {pair.from_coin_id, pair.to_coin_id} if route is None else set(route.coins)
+        direct_pair_price = all_tickers.get_price(pair.from_coin_id + pair.to_coin_id)
+        inverse_pair_price = all_tickers.get_price(pair.to_coin_id + pair.from_coin_id)
+        if (direct_pair_price and direct_pair_price > 1e-6) or (inverse_pair_price and inverse_pair_price > 1e-6):
+            return {pair.from_coin_id, pair.to_coin_id}
+        # The buy spends the whole bridge balance, proceeds of any other jump included
+        return {pair.from_coin_id, pair.to_coin_id, self.config.BRIDGE_SYMBOL}
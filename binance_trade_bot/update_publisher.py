@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from socketio import Client
+from socketio.exceptions import SocketIOError
+
+from .logger import Logger
+from .rate_limiter import backoff_delay
+
+
+class UpdatePublisher:
+    """
+    Sends the rows the bot writes to the API server over socket.io from a background thread, so the trader never waits
+    on the connection. Updates wait in a bounded buffer, and go out as one emit per table every flush interval. A row
+    updated again before it was sent is only sent once, as it is now. While the API server can't be reached the buffer
+    keeps the newest updates, dropping the oldest, and the connection is retried with a growing delay
+    """
+
+    def __init__(self, logger: Logger, url="http://api:5123", flush_interval=1.0, max_pending=10000, timeout=5.0):
+        self.logger = logger
+        self.url = url
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # Reconnects are ours to make, with backoff, rather than done by the client on a thread of its own
+        self.client = Client(reconnection=False)
+        # (table, key) -> (table, data), in the order the updates are to go out
+        self.pending: "OrderedDict[Tuple, Tuple[str, Dict]]" = OrderedDict()
+        # Keys of the updates that are never merged with another one
+        self.sequence = count()
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+
+    def publish(self, table: str, data: Dict, key: Optional[Hashable] = None):
+        """
+        Queue an update without waiting
+
+        :param key: Identifies the row within its table, so a pending update of the same row is replaced. None for
+        updates that are all sent
+        """
+        with self.condition:
+            if self.closed:
+                return
+            pending_key = (table, key) if key is not None else (table, None, next(self.sequence))
+            self.pending.pop(pending_key, None)
+            self.pending[pending_key] = (table, data)
+            while len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.process_updates, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def process_updates(self):
+        attempt = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    return
+            if not self.connect():
+                # Wait before retrying, unless closed in the meantime
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, backoff_delay(attempt, cap=30))
+                attempt += 1
+                continue
+            attempt = 0
+            self.send_pending()
+            with self.condition:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.logger.warning(f"Dropped {dropped} updates that couldn't be sent to the API server in time")
+            # Let the updates of the next interval gather into a batch
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, self.flush_interval)
+
+    def connect(self) -> bool:
+        if self.client.connected and "/backend" in self.client.namespaces:
+            return True
+        try:
+            if self.client.connected:
+                self.client.disconnect()
+            self.client.connect(self.url, namespaces=["/backend"])
+            deadline = time.monotonic() + self.timeout
+            while "/backend" not in self.client.namespaces:
+                if time.monotonic() > deadline:
+                    raise SocketIOError("Timed out connecting to the /backend namespace")
+                time.sleep(0.1)
+        except SocketIOError:
+            return False
+        return True
+
+    def send_pending(self):
+        with self.condition:
+            updates = list(self.pending.values())
+            self.pending.clear()
+        batches: Dict[str, List[Dict]] = {}
+        for table, data in updates:
+            batches.setdefault(table, []).append(data)
+        for table, rows in batches.items():
+            try:
+                # Waiting for the server to acknowledge each batch is what tells a dead connection apart, as emits to
+                # it don't fail
+                self.client.call("updates", {"table": table, "data": rows}, namespace="/backend", timeout=self.timeout)
+            except SocketIOError:
+                # The batch is dropped, and the next updates wait for a reconnect
+                with self.condition:
+                    self.dropped += len(rows)
+                self.client.disconnect()
+                return
+
+    def close(self):
+        """
+        Send what is pending if the API server is reachable, and stop
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            # Don't hold up shutting down on a connection attempt
+            self.thread.join(self.timeout)
+            if self.thread.is_alive():
+                return
+        if self.pending and self.client.connected and "/backend" in self.client.namespaces:
+            self.send_pending()
+        if self.client.connected:
+            self.client.disconnect()
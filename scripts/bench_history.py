@@ -0,0 +1,198 @@
+"""
+Time the history endpoints and the pruning jobs on a large database, and print the query plan of every statement they
+run against the history tables
+
+    python scripts/bench_history.py [--scouts 10000000] [--dir bench_history]
+
+The database is generated in data/crypto_trading.db under --dir, and reused as is when it is already there: delete it
+to generate it again, e.g. after changing the indexes. Pruning runs last, and only deletes the oldest minute of scouts
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COINS = [f"C{i}" for i in range(10)]
+# Scouts saved per second, e.g. one per other coin every second
+SCOUTS_PER_SECOND = 9
+HISTORY_TABLES = ("scout_history", "trade_history", "current_coin_history", "coin_value", "total_value")
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def create_config():
+    if not os.path.exists("user.cfg"):
+        with open("user.cfg", "w") as f:
+            f.write("[binance_user_config]\napi_key=\napi_secret_key=\ncurrent_coin=\n")
+
+
+def generate(path: str, scouts: int):
+    """
+    Scouts over the last days up to now, in UTC, with the current coin changing daily. Coin and total values in local
+    time, as many as pruning keeps: minutely for a day, hourly for 28 days, daily for a year and weekly for 3 years
+    """
+    # pylint: disable=import-outside-toplevel
+    from binance_trade_bot.config import Config
+    from binance_trade_bot.database import Database
+    from binance_trade_bot.logger import Logger
+
+    Database(Logger("bench_history"), Config(), f"sqlite:///{path}").create_database()
+    connection = sqlite3.connect(path)
+    seconds = scouts // SCOUTS_PER_SECOND
+    start = datetime.utcnow() - timedelta(seconds=seconds)
+    days = seconds // 86400 + 1
+
+    connection.executemany("INSERT INTO coins VALUES (?, 1)", [(coin,) for coin in COINS])
+    connection.executemany(
+        "INSERT INTO pairs (id, from_coin_id, to_coin_id, ratio) VALUES (?, ?, ?, 1.0)",
+        [
+            (i * (len(COINS) - 1) + j + 1, from_coin, to_coin)
+            for i, from_coin in enumerate(COINS)
+            for j, to_coin in enumerate(coin for coin in COINS if coin != from_coin)
+        ],
+    )
+    connection.executemany(
+        "INSERT INTO current_coin_history (coin_id, datetime) VALUES (?, ?)",
+        [(COINS[day % len(COINS)], (start + timedelta(days=day)).strftime(DATETIME_FORMAT)) for day in range(days)],
+    )
+    connection.executemany(
+        "INSERT INTO trade_history (alt_coin_id, crypto_coin_id, selling, state, datetime) VALUES (?, 'USDT', ?, "
+        "'COMPLETE', ?)",
+        [
+            (COINS[(day + selling) % len(COINS)], selling, (start + timedelta(days=day)).strftime(DATETIME_FORMAT))
+            for day in range(days)
+            for selling in (1, 0)
+        ],
+    )
+    # Scouts of the current coin against every other one, SCOUTS_PER_SECOND a second
+    connection.execute(
+        f"""
+        WITH RECURSIVE r(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM r WHERE i < {scouts - 1})
+        INSERT INTO scout_history (pair_id, target_ratio, current_coin_price, other_coin_price, datetime)
+        SELECT ((i / {SCOUTS_PER_SECOND} / 86400) % {len(COINS)}) * {len(COINS) - 1} + i % {len(COINS) - 1} + 1,
+            abs(random() % 1000) / 1000.0, abs(random() % 1000) / 1000.0, abs(random() % 1000) / 1000.0 + 0.1,
+            strftime('%Y-%m-%d %H:%M:%S', '{start.strftime("%Y-%m-%d %H:%M:%S")}',
+                '+' || (i / {SCOUTS_PER_SECOND}) || ' seconds') || '.000000'
+        FROM r
+        """
+    )
+
+    now = datetime.now().replace(second=0, microsecond=0)
+    # A point in time has the longest interval it was tagged with
+    intervals: Dict[datetime, str] = {}
+    for interval, step, count in (
+        ("WEEKLY", timedelta(weeks=1), 3 * 52),
+        ("DAILY", timedelta(days=1), 365),
+        ("HOURLY", timedelta(hours=1), 28 * 24),
+        ("MINUTELY", timedelta(minutes=1), 1440),
+    ):
+        for i in range(count):
+            intervals.setdefault(now - step * i, interval)
+    value_times = sorted((date, interval) for date, interval in intervals.items())
+    connection.executemany(
+        "INSERT INTO coin_value (coin_id, balance, usd_price, btc_price, interval, datetime) VALUES (?, 1, 1, 1, ?, ?)",
+        [(coin, interval, date.strftime(DATETIME_FORMAT)) for date, interval in value_times for coin in COINS],
+    )
+    connection.executemany(
+        "INSERT INTO total_value (btc_value, usd_value, interval, datetime) VALUES (?, ?, ?, ?)",
+        [(len(COINS), len(COINS), interval, date.strftime(DATETIME_FORMAT)) for date, interval in value_times],
+    )
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the history endpoints on a large database")
+    parser.add_argument("--scouts", type=int, default=10_000_000, help="Number of scouts to generate")
+    parser.add_argument("--dir", help="Directory of the database, kept for later runs. Default: a temporary one")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each request, the fastest is reported")
+    args = parser.parse_args()
+
+    path = args.dir or tempfile.mkdtemp(prefix="bench_history")
+    os.makedirs(os.path.join(path, "data"), exist_ok=True)
+    os.makedirs(os.path.join(path, "logs"), exist_ok=True)
+    # The API server opens data/crypto_trading.db and reads user.cfg from the working directory when imported
+    os.chdir(path)
+    create_config()
+    db_path = "data/crypto_trading.db"
+    if os.path.exists(db_path):
+        print(f"Using the existing {os.path.abspath(db_path)}")
+    else:
+        started = time.perf_counter()
+        generate(db_path, args.scouts)
+        print(f"Generated {args.scouts} scouts in {os.path.abspath(db_path)} in {time.perf_counter() - started:.1f}s")
+
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import event
+
+    from binance_trade_bot import api_server
+
+    statements: List[Tuple[str, tuple]] = []
+
+    @event.listens_for(api_server.db.engine, "before_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+        if not executemany and any(table in statement for table in HISTORY_TABLES):
+            statements.append((statement, tuple(parameters)))
+
+    def explain(name: str, run, repeat: int):
+        statements.clear()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        print(f"{name:48s} {min(timings) * 1000:9.1f}ms")
+        plans = {}
+        for statement, parameters in statements:
+            if statement.lstrip().upper().startswith(("SELECT", "DELETE", "UPDATE")):
+                connection = api_server.db.engine.raw_connection()
+                try:
+                    plan = connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                finally:
+                    connection.close()
+                plans[" ".join(statement.split())[:100]] = [row[-1] for row in plan]
+        for statement, plan in plans.items():
+            print(f"    {statement}")
+            for step in plan:
+                print(f"        {step}")
+
+    client = api_server.app.test_client()
+    past = datetime.utcnow() - timedelta(days=1)
+    for url in (
+        "/api/scouting_history?period=1h&limit=1000",
+        "/api/scouting_history?period=1d&limit=1000",
+        f"/api/scouting_history?start={(past - timedelta(hours=1)).isoformat()}&end={past.isoformat()}&limit=1000",
+        "/api/scouting_history?period=1h",
+        "/api/trade_history?period=1w",
+        "/api/current_coin_history?period=1w",
+        "/api/value_history/C1?period=1d",
+        "/api/value_history/C1?period=1d&limit=1000",
+        "/api/value_history/C1",
+        "/api/value_history?period=1d&limit=1000",
+        "/api/total_value_history?period=1w",
+    ):
+
+        def get(url=url):
+            response = client.get(url)
+            assert response.status_code == 200, f"{url}: {response.status_code}"
+            # Responses are cached until the database changes, time building them instead
+            api_server.response_cache.clear()
+
+        explain(url, get, args.repeat)
+
+    db = api_server.db
+    oldest = datetime.strptime(
+        sqlite3.connect(db_path).execute("SELECT min(datetime) FROM scout_history").fetchone()[0], DATETIME_FORMAT
+    )
+    db.config.SCOUT_HISTORY_PRUNE_TIME = (datetime.utcnow() - oldest - timedelta(minutes=1)) / timedelta(hours=1)
+    explain("prune_scout_history, oldest minute", db.prune_scout_history, 1)
+    explain("prune_value_history", db.prune_value_history, 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Time keeping an order book current with diff depth events, and getting fill prices from it, on a synthetic book around
+a price of 100 with a tick of 0.01. A third of the levels in each event are removed, the rest updated or added
+
+    python scripts/bench_order_book.py [--events 20000] [--depth 1000] [--fills 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from binance_trade_bot.order_book import OrderBook
+
+MID_PRICE = 100.0
+TICK = 0.01
+
+
+def snapshot(update_id: int, depth: int) -> Dict:
+    return {
+        "lastUpdateId": update_id,
+        "bids": [[f"{MID_PRICE - TICK * (i + 1):.2f}", f"{random.uniform(0.1, 5):.3f}"] for i in range(depth)],
+        "asks": [[f"{MID_PRICE + TICK * (i + 1):.2f}", f"{random.uniform(0.1, 5):.3f}"] for i in range(depth)],
+    }
+
+
+def diff_events(first_update_id: int, count: int, levels: int, spread: int) -> List[Dict]:
+    """
+    Events of levels bids and asks each, at random prices within spread ticks of the middle
+    """
+    events = []
+    update_id = first_update_id
+    for _ in range(count):
+        event = {"e": "depthUpdate", "s": "BENCHUSDT", "U": update_id, "u": update_id + 1, "b": [], "a": []}
+        for side, sign in (("b", -1), ("a", 1)):
+            for _ in range(levels):
+                price = f"{MID_PRICE + sign * TICK * random.randint(1, spread):.2f}"
+                quantity = "0" if random.random() < 1 / 3 else f"{random.uniform(0.1, 5):.3f}"
+                event[side].append([price, quantity])
+        events.append(event)
+        update_id += 2
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark applying diff depth events and getting fill prices")
+    parser.add_argument("--events", type=int, default=20000, help="Number of diff events applied per run")
+    parser.add_argument("--depth", type=int, default=1000, help="Levels on each side of the snapshot")
+    parser.add_argument("--fills", type=int, default=100000, help="Number of fill prices computed per run")
+    args = parser.parse_args()
+    random.seed(1)
+
+    for levels in (5, 20, 50):
+        book = OrderBook()
+        book.load_snapshot(snapshot(10, args.depth))
+        events = diff_events(11, args.events, levels, min(args.depth, 150))
+        started = time.perf_counter()
+        for event in events:
+            assert book.apply_diff(event)
+        elapsed = time.perf_counter() - started
+        print(
+            f"apply_diff, {levels * 2:3d} levels an event: {elapsed / len(events) * 1e6:7.1f}µs an event, "
+            f"{elapsed / len(events) / (levels * 2) * 1e9:5.0f}ns a level, {len(book.bids)}+{len(book.asks)} levels"
+        )
+
+    book = OrderBook()
+    book.load_snapshot(snapshot(10, 100))
+    for name, kwargs in (
+        ("SELL, quantity 20", {"side": "SELL", "quantity": 20}),
+        ("BUY, quantity 20", {"side": "BUY", "quantity": 20}),
+        ("BUY, quote quantity 2000", {"side": "BUY", "quote_quantity": 2000}),
+    ):
+        started = time.perf_counter()
+        for _ in range(args.fills):
+            book.get_fill_price(**kwargs)
+        print(f"get_fill_price, {name:25s} {(time.perf_counter() - started) / args.fills * 1e6:7.2f}µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Check that the vectorized backtest makes the same jumps and ends with the same balances as backtest(), over a small
+random walk of prices written to a kline store in a temporary directory. backtest() runs both scouting every interval,
+which doesn't share the jump decisions with the vectorized engine, and fast forwarded. Exits with status 1 if any differ
+
+    python scripts/check_backtest_parity.py [--minutes 20000]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from binance_trade_bot.auto_trader import AutoTrader
+from binance_trade_bot.backtest import backtest
+from binance_trade_bot.backtest_vectorized import vectorized_backtest
+from binance_trade_bot.config import Config
+from binance_trade_bot.kline_store import KlineStore, minute_of
+from binance_trade_bot.logger import Logger
+
+COINS = ["ADA", "XLM", "EOS", "TRX", "BNB", "ICX"]
+# Pairs between coins, on top of each coin against the bridge
+DIRECT_PAIRS = [("XLM", "ADA"), ("EOS", "BNB"), ("TRX", "XLM"), ("ADA", "BTC")]
+START_DATE = datetime(2021, 1, 1)
+START_BALANCES = {"USDT": 100, "BNB": 0.5}
+
+
+def write_prices(store: KlineStore, minutes: int, seed=7):
+    """
+    Random walks with a few missing minutes, and the exchange info of their symbols
+    """
+    rng = np.random.default_rng(seed)
+    series = {}
+    for coin in COINS + ["BTC"]:
+        prices = np.exp(np.cumsum(rng.normal(0, 0.002, minutes + 10))) * rng.uniform(1, 50)
+        prices[rng.random(minutes + 10) < 0.01] = np.nan
+        series[coin] = prices
+        store.set_prices(coin + "USDT", minute_of(START_DATE), prices)
+    for from_coin, to_coin in DIRECT_PAIRS:
+        prices = series[from_coin] / series[to_coin] * (1 + rng.normal(0, 0.001, minutes + 10))
+        store.set_prices(from_coin + to_coin, minute_of(START_DATE), prices)
+    exchange_info = {
+        "symbols": [
+            {"symbol": symbol, "filters": [{"filterType": "LOT_SIZE", "stepSize": "0.01000000"}]}
+            for symbol in store.symbols()
+        ]
+    }
+    with open("data/exchange_info.json", "w") as f:
+        json.dump(exchange_info, f)
+
+
+def create_config() -> Config:
+    with open("user.cfg", "w") as f:
+        f.write("[binance_user_config]\napi_key=\napi_secret_key=\ncurrent_coin=\n")
+    config = Config()
+    config.SUPPORTED_COIN_LIST = COINS
+    config.SCOUT_MULTIPLIER = 0.2
+    config.STRATEGY = "default"
+    return config
+
+
+def run_backtest(config: Config, logger: Logger, end_date: datetime, interval: int, fast_forward: bool):
+    jumps = []
+    transaction_through_bridge = AutoTrader.transaction_through_bridge
+
+    def record_jump(self, pair, all_tickers):
+        result = transaction_through_bridge(self, pair, all_tickers)
+        if result is not None:
+            jumps.append((self.manager.datetime, pair.from_coin_id, pair.to_coin_id))
+        return result
+
+    AutoTrader.transaction_through_bridge = record_jump
+    try:
+        manager = None
+        for manager in backtest(
+            START_DATE,
+            end_date,
+            interval,
+            yield_interval=10 ** 9,
+            start_balances=dict(START_BALANCES),
+            config=config,
+            logger=logger,
+            offline=True,
+            fast_forward=fast_forward,
+        ):
+            pass
+    finally:
+        AutoTrader.transaction_through_bridge = transaction_through_bridge
+    return manager.balances, jumps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the vectorized backtest with backtest()")
+    parser.add_argument("--minutes", type=int, default=20000, help="Number of minutes of prices to backtest over")
+    args = parser.parse_args()
+
+    matching = True
+    with tempfile.TemporaryDirectory() as path:
+        # The kline store, the exchange info and the logs are all found relative to the working directory
+        os.chdir(path)
+        os.makedirs("data/klines")
+        os.makedirs("logs")
+        write_prices(KlineStore("data/klines"), args.minutes)
+        config = create_config()
+        logger = Logger("backtest_parity", enable_notifications=False)
+        logger.Logger.setLevel(logging.ERROR)
+        end_date = START_DATE + timedelta(minutes=args.minutes)
+
+        for interval in (1, 3):
+            vectorized = vectorized_backtest(START_DATE, end_date, interval, dict(START_BALANCES), config=config)
+            for fast_forward in (False, True):
+                balances, jumps = run_backtest(config, logger, end_date, interval, fast_forward)
+                same_jumps = jumps == vectorized.jumps
+                same_balances = balances == vectorized.balances
+                mode = "fast forwarded" if fast_forward else "stepped"
+                print(f"interval {interval}, {mode}: {len(jumps)} jumps, {len(vectorized.jumps)} vectorized", end="")
+                print(f", same jumps: {same_jumps}, same balances: {same_balances}")
+                if not same_balances:
+                    print(f"  backtest:   {balances}\n  vectorized: {vectorized.balances}")
+                matching = matching and same_jumps and same_balances and len(jumps) > 0
+        # Leave the temporary directory so it can be removed
+        os.chdir("/")
+    sys.exit(0 if matching else 1)
+
+
+if __name__ == "__main__":
+    main()